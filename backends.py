@@ -0,0 +1,270 @@
+import re
+import threading
+import time
+from types import SimpleNamespace
+from typing import Any, Callable, Dict, List, Optional
+
+from batching import Batcher, ContinuousBatcher, LogitsFn, Sequence, StaticBatcher, StopFn, TokenFn
+from prefix_cache import PrefixCache
+
+
+class InferenceBackend:
+    # What the job pipeline needs from a model: a tokenizer for prompts and
+    # token accounting, submit() for queued jobs (callback runs on a backend
+    # thread) and a blocking generate_batch() for the sync/offline path.
+    # Constructing a backend is cheap; load() does the slow part and has to
+    # finish before tokenizer is set or anything else is called.
+    tokenizer: Any = None
+
+    def load(self) -> None:
+        pass
+
+    def start(self) -> None:
+        pass
+
+    def submit(self, prompt: str, callback: Callable[[Sequence], Any], max_new_tokens: Optional[int] = None,
+               stop: Optional[StopFn] = None, logits_processor: Optional[LogitsFn] = None,
+               on_token: Optional[TokenFn] = None) -> Sequence:
+        raise NotImplementedError
+
+    def generate_batch(self, prompts: List[str], stops: Optional[List[Optional[StopFn]]] = None,
+                       logits_processors: Optional[List[Optional[LogitsFn]]] = None) -> List[Sequence]:
+        raise NotImplementedError
+
+    def prefix_cache_stats(self) -> Dict[str, Any]:
+        return {}
+
+
+class UnslothBackend(InferenceBackend):
+    def __init__(self, model_name: str, cache_dir: str, system_prompt: str, batching_mode: str = "continuous",
+                 max_batch_size: int = 8, batch_wait_ms: float = 50, bucket_tokens: int = 128,
+                 prefix_cache_bytes: int = 4 << 30, prefix_block_tokens: int = 32, max_seq_length: int = 2048,
+                 generation_kwargs: Optional[Dict[str, Any]] = None):
+        self.model_name = model_name
+        self.cache_dir = cache_dir
+        self.system_prompt = system_prompt
+        self.batching_mode = batching_mode
+        self.max_batch_size = max_batch_size
+        self.batch_wait_ms = batch_wait_ms
+        self.bucket_tokens = bucket_tokens
+        self.max_seq_length = max_seq_length
+        self.generation_kwargs = generation_kwargs or {}
+        self.prefix_cache = PrefixCache(block_tokens=prefix_block_tokens, max_bytes=prefix_cache_bytes)
+        self.model = None
+        self.batcher: Optional[Batcher] = None
+        self.static_batcher: Optional[StaticBatcher] = None
+
+    def load(self) -> None:
+        from unsloth import FastLanguageModel
+
+        # Load base model (4-bit quantized for A100 efficiency)
+        model, tokenizer = FastLanguageModel.from_pretrained(
+            model_name=self.model_name,
+            max_seq_length=self.max_seq_length,
+            load_in_4bit=True,
+            load_in_8bit=False,
+            dtype=None,
+            cache_dir=self.cache_dir
+        )
+        FastLanguageModel.for_inference(model)
+
+        self.static_batcher = StaticBatcher(
+            model, tokenizer,
+            max_wait_ms=self.batch_wait_ms,
+            bucket_tokens=self.bucket_tokens,
+            max_batch_size=self.max_batch_size,
+            **self.generation_kwargs
+        )
+        if self.batching_mode == "static":
+            self.batcher = self.static_batcher
+        else:
+            self.batcher = ContinuousBatcher(
+                model, tokenizer,
+                prefix=tokenizer.apply_chat_template([{"role": "system", "content": self.system_prompt}], tokenize=False),
+                prefix_cache=self.prefix_cache,
+                max_batch_size=self.max_batch_size,
+                **self.generation_kwargs
+            )
+        self.model, self.tokenizer = model, tokenizer
+
+    def start(self) -> None:
+        self.batcher.start()
+
+    def submit(self, prompt, callback, max_new_tokens=None, stop=None, logits_processor=None, on_token=None) -> Sequence:
+        return self.batcher.submit(prompt, callback, max_new_tokens, stop, logits_processor, on_token)
+
+    def generate_batch(self, prompts, stops=None, logits_processors=None) -> List[Sequence]:
+        return self.static_batcher.generate_batch(prompts, stops, logits_processors)
+
+    def prefix_cache_stats(self) -> Dict[str, Any]:
+        # only the continuous batcher prefills on top of cached prefixes
+        enabled = isinstance(self.batcher, ContinuousBatcher) and self.batcher.prefix_cache is not None
+        return {"enabled": enabled, **self.prefix_cache.stats()}
+
+
+MOCK_RESPONSE = """vided a response from an organization regarding their investment model's flexibility in financial support. The question was about how much their investment model allows for quick and dynamic financial adjustments.
+
+First, I need to compare the organization's answer to the best and worst answers given. The best answer mentions initial investments in incubation periods, moving towards revenue-generating areas, evaluating at milestones, and having easy access to additional funding if needed. The worst answer relies on annual sales forecasts, annual reassessment, and only funds low-risk projects with guaranteed returns.
+
+The organization's response states that funding is mainly based on periodic budgeting and sales forecasts but allows for mid-term reviews and resource reallocation for prioritized projects. However, the evaluation and continuation of investments aren't uniformly milestone-based across all projects.
+
+Now, identifying root causes. The first point is reliance on periodic budgeting and sales forecasts. This suggests a lack of real-time adaptability. The second is inconsistent milestone-based evaluation, meaning some projects might not be assessed properly. Third, limited flexibility in reallocating resources, implying that even though there's some reallocation, it's not comprehensive or systematic.
+
+The score should reflect these issues. Since the organization has some flexibility but lacks uniform processes and real-time adjustments, a score around 5-6 makes sense. Considering the best answer has a robust system and the worst is rigid, the organization is in the middle but leaning towards moderate. So, a score of 5 seems appropriate.
+</think>
+
+<output>
+  <root_causes>
+    <cause>اعتماد زیاد به بودجه‌ریزی دوره‌ای و پیش‌بینی فروش به جای سیستم‌های پویا برای واکنش به تغییرات بازار</cause>
+    <cause>عدم اعمال یکنواخت ارزیابی مایلستون در تمام پروژه‌ها که منجر به عدم همگونی در مدیریت سرمایه می‌شود</cause>
+    <cause>امکان بازنگری بین‌دوره‌ای و جابه‌جایی منابع فقط در برخی موارد و بدون چارچوب سیستماتیک</cause>
+    <cause>عدم تامین مالی مجدد آسان در صورت نیاز به دلیل عدم وجود مکانیزم‌های پویا برای جذب سرمایه</cause>
+  </root_causes>
+  <score>5</score>
+</output>"""
+
+
+class MockTokenizer:
+    # Word-level stand-in for the Qwen tokenizer: every tag, whitespace run
+    # and word is one token, ids are handed out on first sight. Covers the
+    # parts of the HF tokenizer API the pipeline uses.
+    PATTERN = re.compile(r"<\|?/?\w+\|?>|\s+|[^\s<]+|<")
+    SPECIAL = ("<|endoftext|>", "<|im_start|>", "<|im_end|>")
+
+    def __init__(self):
+        self._ids: Dict[str, int] = {}
+        self._pieces: List[str] = []
+        self._lock = threading.Lock()
+        for piece in self.SPECIAL + ("<think>", "</think>"):
+            self.convert_tokens_to_ids(piece)
+        self.eos_token_id = self.pad_token_id = 0
+        self.all_special_ids = [self._ids[piece] for piece in self.SPECIAL]
+        self.added_tokens_decoder: Dict[int, Any] = {}
+
+    def __len__(self) -> int:
+        return len(self._pieces)
+
+    def __call__(self, text, **kwargs) -> SimpleNamespace:
+        if isinstance(text, list):
+            return SimpleNamespace(input_ids=[self.encode(item) for item in text])
+        return SimpleNamespace(input_ids=self.encode(text))
+
+    def convert_tokens_to_ids(self, piece: str) -> int:
+        token_id = self._ids.get(piece)
+        if token_id is None:
+            with self._lock:
+                token_id = self._ids.setdefault(piece, len(self._pieces))
+                if token_id == len(self._pieces):
+                    self._pieces.append(piece)
+        return token_id
+
+    def encode(self, text: str, add_special_tokens: bool = True) -> List[int]:
+        return [self.convert_tokens_to_ids(piece) for piece in self.PATTERN.findall(text)]
+
+    def decode(self, ids: List[int], skip_special_tokens: bool = False) -> str:
+        skip = set(self.all_special_ids) if skip_special_tokens else ()
+        return "".join(self._pieces[token_id] for token_id in ids if token_id not in skip)
+
+    def batch_decode(self, batch: List[List[int]], skip_special_tokens: bool = False) -> List[str]:
+        return [self.decode(ids, skip_special_tokens) for ids in batch]
+
+    def apply_chat_template(self, messages: List[Dict[str, str]], tokenize: bool = False,
+                            add_generation_prompt: bool = False, enable_thinking: bool = True) -> str:
+        text = "".join(f"<|im_start|>{message['role']}\n{message['content']}<|im_end|>\n" for message in messages)
+        if add_generation_prompt:
+            text += "<|im_start|>assistant\n"
+            if not enable_thinking:
+                text += "<think>\n\n</think>\n\n"
+        return self.encode(text) if tokenize else text
+
+
+class MockBatcher(Batcher):
+    # Replays a canned answer with the timing of a continuous batcher: each
+    # admission round costs prefill_ms and every decode step emits one token
+    # to each of up to max_batch_size sequences at tokens_per_second. The
+    # stop and on_token hooks run as usual; logits processors are skipped
+    # since there are no logits.
+    def __init__(self, tokenizer, response: str = MOCK_RESPONSE, prefill_ms: float = 50,
+                 tokens_per_second: float = 30, **kwargs):
+        super().__init__(None, tokenizer, device="cpu", **kwargs)
+        self.prefill_ms = prefill_ms
+        self.tokens_per_second = tokens_per_second
+        self.thinking_ids = tokenizer.encode(response) + [tokenizer.eos_token_id]
+        answer = response.split("</think>", 1)[1].lstrip() if "</think>" in response else response
+        self.answer_ids = tokenizer.encode(answer) + [tokenizer.eos_token_id]
+        self.active: List[Sequence] = []
+
+    def _run(self) -> None:
+        while True:
+            # block for work only when nothing is decoding
+            admitted = [] if self.active else [self.pending.get()]
+            while len(self.active) + len(admitted) < self.max_batch_size and not self.pending.empty():
+                admitted.append(self.pending.get_nowait())
+            if admitted:
+                for seq in admitted:
+                    seq.mark("admitted")
+                    seq.prompt_ids = self.tokenizer(seq.prompt).input_ids
+                    seq.mark("tokenized")
+                    seq.mark("prefill_start")
+                time.sleep(self.prefill_ms / 1000)
+                self.active += admitted
+            time.sleep(1 / self.tokens_per_second)
+            for seq in list(self.active):
+                try:
+                    self._step(seq)
+                except Exception as e:
+                    seq.error = f"{type(e).__name__}: {e}"
+                    self.active.remove(seq)
+                    self._finish(seq, "error")
+
+    def _step(self, seq: Sequence) -> None:
+        # prompts rendered with thinking disabled already end in </think>
+        script = self.answer_ids if seq.prompt.rstrip().endswith("</think>") else self.thinking_ids
+        token = script[min(len(seq.output_ids), len(script) - 1)]
+        seq.mark("first_token")
+        reason = None
+        if token == self.tokenizer.eos_token_id:
+            reason = "eos"
+        else:
+            seq.output_ids.append(token)
+            if seq.on_token is not None:
+                seq.on_token(seq.output_ids)
+            if seq.stop is not None and seq.stop(seq.output_ids):
+                reason = "stop"
+            elif len(seq.output_ids) >= seq.max_new_tokens:
+                reason = "length"
+        if reason is not None:
+            self.active.remove(seq)
+            self._finish(seq, reason)
+
+
+class MockBackend(InferenceBackend):
+    # CPU-only backend for exercising the scheduler, queues and API without
+    # the model
+    def __init__(self, response: str = MOCK_RESPONSE, prefill_ms: float = 50, tokens_per_second: float = 30,
+                 max_batch_size: int = 8, generation_kwargs: Optional[Dict[str, Any]] = None):
+        self.tokenizer = MockTokenizer()
+        self.batcher = MockBatcher(
+            self.tokenizer, response,
+            prefill_ms=prefill_ms,
+            tokens_per_second=tokens_per_second,
+            max_batch_size=max_batch_size,
+            **(generation_kwargs or {})
+        )
+
+    def start(self) -> None:
+        self.batcher.start()
+
+    def submit(self, prompt, callback, max_new_tokens=None, stop=None, logits_processor=None, on_token=None) -> Sequence:
+        return self.batcher.submit(prompt, callback, max_new_tokens, stop, logits_processor, on_token)
+
+    def generate_batch(self, prompts, stops=None, logits_processors=None) -> List[Sequence]:
+        self.start()
+        done = threading.Semaphore(0)
+        batch = [
+            self.batcher.submit(prompt, lambda seq: done.release(), stop=stop)
+            for prompt, stop in zip(prompts, stops or [None] * len(prompts))
+        ]
+        for _ in batch:
+            done.acquire()
+        return batch
@@ -0,0 +1,81 @@
+import json
+import os
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple, Type
+
+from pydantic import BaseModel, ValidationError
+
+
+def completed_lines(output_path: str) -> int:
+    # The output file is the checkpoint: one line per processed input record,
+    # written in input order. A torn last line from a crash is cut off.
+    if not os.path.exists(output_path):
+        return 0
+    count = 0
+    good_bytes = 0
+    with open(output_path, "rb") as f:
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+            count += 1
+            good_bytes += len(line)
+    with open(output_path, "r+b") as f:
+        f.truncate(good_bytes)
+    return count
+
+
+def read_records(input_path: str, skip: int) -> Iterator[Tuple[int, str]]:
+    with open(input_path, "r", encoding="utf-8") as f:
+        line_no = 0
+        for line in f:
+            if not line.strip():
+                continue
+            if line_no >= skip:
+                yield line_no, line
+            line_no += 1
+
+
+def run_jsonl(
+    input_path: str,
+    output_path: str,
+    model: Type[BaseModel],
+    process_batch: Callable[[List[Any]], List[Dict[str, Any]]],
+    prompt_length: Callable[[Any], int],
+    batch_size: int = 8,
+    window: int = 64,
+    log: Optional[Callable[[str], None]] = print,
+) -> int:
+    # Streams input records through process_batch and appends one JSON line
+    # per record to output_path. Each window of records is sorted by prompt
+    # length and cut into batches of similar length to keep padding low, then
+    # written back in input order, so an interrupted run resumes after the
+    # last complete window.
+    done = completed_lines(output_path)
+    if done and log:
+        log(f"resuming after {done} records")
+    processed = 0
+    records = read_records(input_path, done)
+    with open(output_path, "a", encoding="utf-8") as out:
+        while True:
+            chunk = [record for _, record in zip(range(window), records)]
+            if not chunk:
+                break
+            rows: List[Optional[Dict[str, Any]]] = [None] * len(chunk)
+            valid: List[Tuple[int, Any]] = []
+            for index, (line_no, line) in enumerate(chunk):
+                try:
+                    valid.append((index, model.model_validate_json(line)))
+                except ValidationError as e:
+                    rows[index] = {"line": line_no, "error": str(e)}
+            valid.sort(key=lambda item: prompt_length(item[1]))
+            for start in range(0, len(valid), batch_size):
+                batch = valid[start:start + batch_size]
+                results = process_batch([request for _, request in batch])
+                for (index, _), result in zip(batch, results):
+                    rows[index] = {"line": chunk[index][0], "result": result}
+            out.write("".join(json.dumps(row, ensure_ascii=False) + "\n" for row in rows))
+            out.flush()
+            os.fsync(out.fileno())
+            processed += len(chunk)
+            if log:
+                log(f"processed {done + processed} records")
+    return processed
@@ -0,0 +1,499 @@
+import queue
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+import torch
+import torch.nn.functional as F
+from transformers import LogitsProcessor, LogitsProcessorList, StoppingCriteria, StoppingCriteriaList
+
+from prefix_cache import PrefixCache
+
+
+def sample_next_tokens(logits: torch.Tensor, temperature: float, top_p: float, top_k: int) -> torch.Tensor:
+    logits = logits.float() / max(temperature, 1e-5)
+    if top_k > 0:
+        kth = torch.topk(logits, min(top_k, logits.shape[-1]), dim=-1).values[:, -1:]
+        logits = logits.masked_fill(logits < kth, float("-inf"))
+    if top_p < 1.0:
+        sorted_logits, sorted_idx = torch.sort(logits, descending=True, dim=-1)
+        sorted_probs = sorted_logits.softmax(dim=-1)
+        # drop a token once the mass before it already covers top_p
+        remove = sorted_probs.cumsum(dim=-1) - sorted_probs > top_p
+        sorted_logits = sorted_logits.masked_fill(remove, float("-inf"))
+        logits = torch.full_like(logits, float("-inf")).scatter(1, sorted_idx, sorted_logits)
+    return torch.multinomial(logits.softmax(dim=-1), num_samples=1).squeeze(1)
+
+
+def split_cache(past) -> List[tuple]:
+    if hasattr(past, "to_legacy_cache"):
+        return [tuple(layer) for layer in past.to_legacy_cache()]
+    if hasattr(past, "layers"):
+        return [(layer.keys, layer.values) for layer in past.layers]
+    return [tuple(layer) for layer in past]
+
+
+def join_cache(layers: List[tuple], cache_type: type):
+    # keep whatever format the model handed us (DynamicCache or legacy tuples)
+    if issubclass(cache_type, (tuple, list)):
+        return tuple(layers)
+    cache = cache_type()
+    for idx, (key, value) in enumerate(layers):
+        cache.update(key, value, idx)
+    return cache
+
+
+def reset_fast_inference_state(model) -> None:
+    # Unsloth's fast decode path keeps its own per-layer KV buffer and only
+    # re-reads past_key_values when that buffer is missing. Dropping it after
+    # we reshape the batch cache makes the next step start from our tensors.
+    for module in model.modules():
+        if hasattr(module, "paged_attention"):
+            del module.paged_attention
+
+
+def _rotate_half(x: torch.Tensor) -> torch.Tensor:
+    half = x.shape[-1] // 2
+    return torch.cat((-x[..., half:], x[..., :half]), dim=-1)
+
+
+def _rope(model, x: torch.Tensor, positions: torch.Tensor) -> tuple:
+    # HF rotary modules map position ids to cos/sin; Unsloth swaps in one
+    # that hands out whole tables from get_cached(), indexed here instead
+    rotary = getattr(model.model, "rotary_emb", None)
+    if rotary is None:
+        rotary = model.model.layers[0].self_attn.rotary_emb
+    if hasattr(rotary, "get_cached"):
+        end = int(positions[-1]) + 1
+        rotary.extend_rope_embedding(x, end)
+        cos, sin = rotary.get_cached(end, x.device.index)
+        return cos[positions].to(x.dtype), sin[positions].to(x.dtype)
+    cos, sin = rotary(x, positions.unsqueeze(0))
+    return cos[0], sin[0]
+
+
+@torch.inference_mode()
+def prefill_on_cache(model, input_ids: torch.Tensor, start: int, layers: List[tuple]) -> tuple:
+    # Runs input_ids[:, start:] on top of the cached KV of the first start
+    # tokens, layer by layer from the model's own modules. model(...) cannot
+    # do this under Unsloth: its patched forward sends every call with
+    # past_key_values to a one-token decode kernel (assert q_len == 1).
+    # Covers Llama/Qwen-style decoders, Qwen3's q/k norms included. Returns
+    # the last position's logits and the KV of the whole prompt.
+    decoder = model.model
+    config = model.config
+    head_dim = getattr(config, "head_dim", None) or config.hidden_size // config.num_attention_heads
+    hidden = decoder.embed_tokens(input_ids[:, start:])
+    q_len = hidden.shape[1]
+    cos, sin = _rope(model, hidden, torch.arange(start, start + q_len, device=hidden.device))
+    cos, sin = cos[None, None], sin[None, None]
+    # query i sees the whole cached prefix and the suffix up to itself
+    mask = torch.ones((q_len, start + q_len), dtype=torch.bool, device=hidden.device).tril(start)
+    present = []
+    for layer, (past_k, past_v) in zip(decoder.layers, layers):
+        attn = layer.self_attn
+        x = layer.input_layernorm(hidden)
+        shape = (1, q_len, -1, head_dim)
+        q, k = attn.q_proj(x).view(shape), attn.k_proj(x).view(shape)
+        v = attn.v_proj(x).view(shape).transpose(1, 2)
+        if hasattr(attn, "q_norm"):
+            q, k = attn.q_norm(q), attn.k_norm(k)
+        q, k = q.transpose(1, 2), k.transpose(1, 2)
+        q = q * cos + _rotate_half(q) * sin
+        k = torch.cat([past_k, k * cos + _rotate_half(k) * sin], dim=2)
+        v = torch.cat([past_v, v], dim=2)
+        present.append((k, v))
+        groups = q.shape[1] // k.shape[1]
+        out = F.scaled_dot_product_attention(
+            q, k.repeat_interleave(groups, dim=1), v.repeat_interleave(groups, dim=1),
+            attn_mask=mask, scale=head_dim ** -0.5
+        )
+        hidden = hidden + attn.o_proj(out.transpose(1, 2).reshape(1, q_len, -1))
+        hidden = hidden + layer.mlp(layer.post_attention_layernorm(hidden))
+    return model.lm_head(decoder.norm(hidden[:, -1:])), present
+
+
+def _pad_kv(tensor: torch.Tensor, width: int) -> torch.Tensor:
+    return F.pad(tensor, (0, 0, width - tensor.shape[2], 0))
+
+
+def _pad_mask(mask: torch.Tensor, width: int) -> torch.Tensor:
+    return F.pad(mask, (width - mask.shape[1], 0))
+
+
+StopFn = Callable[[List[int]], bool]
+LogitsFn = Callable[[List[int], torch.Tensor], torch.Tensor]
+TokenFn = Callable[[List[int]], Any]
+
+
+class Sequence:
+    def __init__(self, prompt: str, callback: Optional[Callable[["Sequence"], Any]], max_new_tokens: int,
+                 stop: Optional[StopFn] = None, logits_processor: Optional[LogitsFn] = None,
+                 on_token: Optional[TokenFn] = None):
+        self.prompt = prompt
+        self.callback = callback
+        self.max_new_tokens = max_new_tokens
+        # called with the generated ids after every token, True ends the sequence
+        self.stop = stop
+        # called with the generated ids and the next-token logits row
+        self.logits_processor = logits_processor
+        # called with the generated ids whenever a token is appended
+        self.on_token = on_token
+        self.prompt_ids: List[int] = []
+        self.output_ids: List[int] = []
+        self.text: Optional[str] = None
+        self.error: Optional[str] = None
+        self.finish_reason: Optional[str] = None
+        # time.monotonic() when each stage was reached: submitted, admitted,
+        # tokenized, prefill_start, first_token, generated, decoded
+        self.timings: Dict[str, float] = {"submitted": time.monotonic()}
+
+    def mark(self, stage: str) -> None:
+        self.timings.setdefault(stage, time.monotonic())
+
+
+class Batcher:
+    def __init__(self, model, tokenizer, max_batch_size: int = 8, max_new_tokens: int = 2048,
+                 temperature: float = 0.6, top_p: float = 0.9, top_k: int = 20, device: str = "cuda"):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_batch_size = max_batch_size
+        self.max_new_tokens = max_new_tokens
+        self.temperature = temperature
+        self.top_p = top_p
+        self.top_k = top_k
+        self.device = device
+        self.pending: "queue.Queue[Sequence]" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name=type(self).__name__, daemon=True)
+            self._thread.start()
+
+    def submit(self, prompt: str, callback: Callable[[Sequence], Any], max_new_tokens: Optional[int] = None,
+               stop: Optional[StopFn] = None, logits_processor: Optional[LogitsFn] = None,
+               on_token: Optional[TokenFn] = None) -> Sequence:
+        seq = Sequence(prompt, callback, max_new_tokens or self.max_new_tokens, stop, logits_processor, on_token)
+        self.pending.put(seq)
+        return seq
+
+    def _run(self) -> None:
+        raise NotImplementedError
+
+    def _finish(self, seq: Sequence, reason: str) -> None:
+        seq.finish_reason = reason
+        seq.mark("generated")
+        if seq.error is None:
+            seq.text = self.tokenizer.decode(seq.output_ids, skip_special_tokens=True)
+            seq.mark("decoded")
+        try:
+            seq.callback(seq)
+        except Exception:
+            pass
+
+
+class ContinuousBatcher(Batcher):
+    # Iteration-level batching: every decode step runs all active sequences
+    # together, finished ones leave the batch and pending ones are prefilled
+    # and merged in before the next step.
+    def __init__(self, model, tokenizer, prefix: Optional[str] = None, prefix_cache: Optional[PrefixCache] = None, **kwargs):
+        super().__init__(model, tokenizer, **kwargs)
+        self.active: List[Sequence] = []
+        self.cache = None
+        self.attention_mask: Optional[torch.Tensor] = None
+        self.last_tokens: Optional[torch.Tensor] = None
+        self._cache_changed = False
+        # Prompts are prefilled on top of the longest prefix found in
+        # prefix_cache. The text every prompt starts with is prefilled once
+        # at startup and pinned there. Without a cache every prompt is
+        # prefilled in full.
+        self.prefix = prefix
+        self.prefix_cache = prefix_cache
+        self._cache_type: Optional[type] = None
+
+    def _run(self) -> None:
+        if self.prefix and self.prefix_cache is not None:
+            try:
+                self._prefill_prefix()
+            except Exception as e:
+                print(f"prefix prefill failed, prompts will be prefilled in full: {e}")
+        while True:
+            try:
+                self._admit()
+                if self.active:
+                    self._step()
+            except Exception as e:
+                self._fail_active(e)
+
+    def _sample(self, logits: torch.Tensor, seqs: List[Sequence]) -> torch.Tensor:
+        logits = logits.float()
+        for row, seq in enumerate(seqs):
+            if seq.logits_processor is not None:
+                logits[row] = seq.logits_processor(seq.output_ids, logits[row])
+        return sample_next_tokens(logits, self.temperature, self.top_p, self.top_k)
+
+    @torch.inference_mode()
+    def _admit(self) -> None:
+        while len(self.active) < self.max_batch_size:
+            try:
+                # only block when there is nothing left to decode
+                seq = self.pending.get(block=not self.active)
+            except queue.Empty:
+                return
+            try:
+                self._prefill(seq)
+            except Exception as e:
+                seq.error = f"{type(e).__name__}: {e}"
+                self._finish(seq, "error")
+
+    @torch.inference_mode()
+    def _prefill_prefix(self) -> None:
+        input_ids = self.tokenizer(self.prefix, return_tensors="pt").input_ids.to(self.device)
+        outputs = self.model(input_ids=input_ids, use_cache=True)
+        self._cache_type = type(outputs.past_key_values)
+        self.prefix_cache.insert(input_ids[0].tolist(), split_cache(outputs.past_key_values), pinned=True)
+
+    def _prefill(self, seq: Sequence) -> None:
+        seq.mark("admitted")
+        input_ids = self.tokenizer(seq.prompt, return_tensors="pt").input_ids.to(self.device)
+        seq.prompt_ids = input_ids[0].tolist()
+        seq.mark("tokenized")
+        seq.mark("prefill_start")
+        start, layers = 0, None
+        if self.prefix_cache is not None:
+            # leave at least one token to run so there are logits to sample from
+            start, layers = self.prefix_cache.match(seq.prompt_ids, limit=len(seq.prompt_ids) - 1)
+        if start:
+            logits, layers = prefill_on_cache(self.model, input_ids, start, layers)
+            seq_cache = join_cache(layers, self._cache_type)
+        else:
+            outputs = self.model(input_ids=input_ids, use_cache=True)
+            logits, seq_cache = outputs.logits, outputs.past_key_values
+            self._cache_type = type(seq_cache)
+            layers = split_cache(seq_cache)
+        if self.prefix_cache is not None:
+            self.prefix_cache.insert(seq.prompt_ids, layers)
+        token = self._sample(logits[:, -1, :], [seq])
+        if self._append(seq, int(token[0])):
+            return
+        self._merge(seq, seq_cache, input_ids.shape[1], token)
+
+    def _merge(self, seq: Sequence, seq_cache, length: int, token: torch.Tensor) -> None:
+        mask = torch.ones((1, length), dtype=torch.long, device=self.device)
+        if not self.active:
+            self.cache, self.attention_mask, self.last_tokens = seq_cache, mask, token.view(1, 1)
+        else:
+            width = max(self.attention_mask.shape[1], length)
+            layers = [
+                (torch.cat([_pad_kv(k, width), _pad_kv(new_k, width)]),
+                 torch.cat([_pad_kv(v, width), _pad_kv(new_v, width)]))
+                for (k, v), (new_k, new_v) in zip(split_cache(self.cache), split_cache(seq_cache))
+            ]
+            self.cache = join_cache(layers, type(self.cache))
+            self.attention_mask = torch.cat([_pad_mask(self.attention_mask, width), _pad_mask(mask, width)])
+            self.last_tokens = torch.cat([self.last_tokens, token.view(1, 1)])
+        self.active.append(seq)
+        self._cache_changed = True
+
+    @torch.inference_mode()
+    def _step(self) -> None:
+        if self._cache_changed:
+            reset_fast_inference_state(self.model)
+            self._cache_changed = False
+        batch_size = len(self.active)
+        self.attention_mask = torch.cat(
+            [self.attention_mask, torch.ones((batch_size, 1), dtype=torch.long, device=self.device)], dim=1
+        )
+        position_ids = self.attention_mask.sum(dim=1, keepdim=True) - 1
+        outputs = self.model(
+            input_ids=self.last_tokens,
+            attention_mask=self.attention_mask,
+            position_ids=position_ids,
+            past_key_values=self.cache,
+            use_cache=True,
+        )
+        self.cache = outputs.past_key_values
+        tokens = self._sample(outputs.logits[:, -1, :], self.active)
+        self.last_tokens = tokens.view(-1, 1)
+        finished = [idx for idx, (seq, token) in enumerate(zip(self.active, tokens.tolist())) if self._append(seq, token)]
+        if finished:
+            self._evict(finished)
+
+    def _append(self, seq: Sequence, token: int) -> bool:
+        seq.mark("first_token")
+        if token == self.tokenizer.eos_token_id:
+            self._finish(seq, "eos")
+            return True
+        seq.output_ids.append(token)
+        if seq.on_token is not None:
+            seq.on_token(seq.output_ids)
+        if seq.stop is not None and seq.stop(seq.output_ids):
+            self._finish(seq, "stop")
+            return True
+        if len(seq.output_ids) >= seq.max_new_tokens:
+            self._finish(seq, "length")
+            return True
+        return False
+
+    def _evict(self, rows: List[int]) -> None:
+        keep = [idx for idx in range(len(self.active)) if idx not in rows]
+        self.active = [self.active[idx] for idx in keep]
+        if not keep:
+            self.cache = self.attention_mask = self.last_tokens = None
+            return
+        index = torch.tensor(keep, device=self.device)
+        mask = self.attention_mask.index_select(0, index)
+        # columns that are padding for every remaining row can go too
+        start = int((mask.sum(dim=0) > 0).nonzero()[0])
+        layers = [(k.index_select(0, index)[:, :, start:], v.index_select(0, index)[:, :, start:])
+                  for k, v in split_cache(self.cache)]
+        self.cache = join_cache(layers, type(self.cache))
+        self.attention_mask = mask[:, start:]
+        self.last_tokens = self.last_tokens.index_select(0, index)
+        self._cache_changed = True
+
+    def _fail_active(self, error: Exception) -> None:
+        failed, self.active = self.active, []
+        self.cache = self.attention_mask = self.last_tokens = None
+        for seq in failed:
+            seq.error = f"{type(error).__name__}: {error}"
+            self._finish(seq, "error")
+
+
+class _RowLogitsProcessor(LogitsProcessor):
+    # Applies each row's own logits processor inside model.generate
+    def __init__(self, batch: List[Sequence], prompt_width: int):
+        self.batch = batch
+        self.prompt_width = prompt_width
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+        for row, seq in enumerate(self.batch):
+            if seq.logits_processor is not None:
+                scores[row] = seq.logits_processor(input_ids[row, self.prompt_width:].tolist(), scores[row])
+        return scores
+
+
+class _RowStoppingCriteria(StoppingCriteria):
+    # Runs each row's token hook and stop callable inside model.generate
+    def __init__(self, batch: List[Sequence], prompt_width: int, end_ids: set):
+        self.batch = batch
+        self.prompt_width = prompt_width
+        self.end_ids = end_ids
+        self.stopped = [False] * len(batch)
+        self.ended = [False] * len(batch)
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        for row, seq in enumerate(self.batch):
+            seq.mark("first_token")
+            if self.stopped[row] or self.ended[row]:
+                continue
+            output_ids = input_ids[row, self.prompt_width:].tolist()
+            if output_ids[-1] in self.end_ids:
+                self.ended[row] = True
+                continue
+            if seq.on_token is not None:
+                seq.on_token(output_ids)
+            if seq.stop is not None:
+                self.stopped[row] = seq.stop(output_ids)
+        return torch.tensor(self.stopped, dtype=torch.bool, device=input_ids.device)
+
+
+class StaticBatcher(Batcher):
+    # Collects prompts into buckets of similar token length and runs each
+    # bucket through a single left-padded model.generate call once it is
+    # full or its oldest prompt has waited max_wait_ms.
+    def __init__(self, model, tokenizer, max_wait_ms: float = 50, bucket_tokens: int = 128, **kwargs):
+        super().__init__(model, tokenizer, **kwargs)
+        self.max_wait = max_wait_ms / 1000
+        self.bucket_tokens = bucket_tokens
+
+    def _run(self) -> None:
+        buckets: Dict[int, List[Sequence]] = {}
+        deadlines: Dict[int, float] = {}
+        while True:
+            timeout = max(0.0, min(deadlines.values()) - time.monotonic()) if deadlines else None
+            try:
+                seq = self.pending.get(timeout=timeout)
+                seq.mark("admitted")
+                seq.prompt_ids = self.tokenizer(seq.prompt).input_ids
+                seq.mark("tokenized")
+                key = len(seq.prompt_ids) // self.bucket_tokens
+                buckets.setdefault(key, []).append(seq)
+                deadlines.setdefault(key, time.monotonic() + self.max_wait)
+            except queue.Empty:
+                pass
+            now = time.monotonic()
+            for key in list(buckets):
+                if len(buckets[key]) >= self.max_batch_size or now >= deadlines[key]:
+                    batch = buckets.pop(key)
+                    deadlines.pop(key)
+                    self._run_batch(batch)
+
+    def _run_batch(self, batch: List[Sequence]) -> None:
+        try:
+            stopped = self._generate(batch)
+        except Exception as e:
+            for seq in batch:
+                seq.error = f"{type(e).__name__}: {e}"
+                self._finish(seq, "error")
+            return
+        for seq, was_stopped in zip(batch, stopped):
+            if was_stopped:
+                self._finish(seq, "stop")
+            else:
+                self._finish(seq, "length" if len(seq.output_ids) >= seq.max_new_tokens else "eos")
+
+    def generate_batch(self, prompts: List[str], stops: Optional[List[Optional[StopFn]]] = None,
+                       logits_processors: Optional[List[Optional[LogitsFn]]] = None) -> List[Sequence]:
+        # runs on the calling thread; errors propagate instead of failing the sequences
+        batch = [
+            Sequence(prompt, None, self.max_new_tokens, stop, processor)
+            for prompt, stop, processor in zip(prompts, stops or [None] * len(prompts), logits_processors or [None] * len(prompts))
+        ]
+        for seq in batch:
+            seq.mark("admitted")
+            seq.prompt_ids = self.tokenizer(seq.prompt).input_ids
+            seq.mark("tokenized")
+        stopped = self._generate(batch)
+        for seq, was_stopped in zip(batch, stopped):
+            seq.finish_reason = "stop" if was_stopped else "length" if len(seq.output_ids) >= seq.max_new_tokens else "eos"
+            seq.mark("generated")
+            seq.text = self.tokenizer.decode(seq.output_ids, skip_special_tokens=True)
+            seq.mark("decoded")
+        return batch
+
+    @torch.inference_mode()
+    def _generate(self, batch: List[Sequence]) -> List[bool]:
+        pad_token_id = self.tokenizer.pad_token_id
+        if pad_token_id is None:
+            pad_token_id = self.tokenizer.eos_token_id
+        prompt_ids = [seq.prompt_ids for seq in batch]
+        width = max(len(ids) for ids in prompt_ids)
+        input_ids = torch.tensor([[pad_token_id] * (width - len(ids)) + ids for ids in prompt_ids], device=self.device)
+        attention_mask = torch.tensor([[0] * (width - len(ids)) + [1] * len(ids) for ids in prompt_ids], device=self.device)
+        end_ids = {self.tokenizer.eos_token_id, pad_token_id}
+        for seq in batch:
+            seq.mark("prefill_start")
+        stopping = _RowStoppingCriteria(batch, width, end_ids)
+        outputs = self.model.generate(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            max_new_tokens=max(seq.max_new_tokens for seq in batch),
+            temperature=self.temperature,
+            top_p=self.top_p,
+            top_k=self.top_k,
+            do_sample=True,
+            pad_token_id=pad_token_id,
+            eos_token_id=self.tokenizer.eos_token_id,
+            stopping_criteria=StoppingCriteriaList([stopping]),
+            logits_processor=LogitsProcessorList([_RowLogitsProcessor(batch, width)]),
+        )
+        for seq, row in zip(batch, outputs[:, width:].tolist()):
+            # finished rows are padded out to the longest one
+            for end_token in end_ids:
+                if end_token in row:
+                    row = row[:row.index(end_token)]
+            seq.output_ids = row[:seq.max_new_tokens]
+            seq.mark("generated")
+        return stopping.stopped
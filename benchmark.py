@@ -0,0 +1,216 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import threading
+import time
+from datetime import datetime
+from typing import Any, Dict, Iterator, List, Optional
+
+# Load test for the job API. Runs the app in-process on the mock backend
+# unless INFERENCE_BACKEND says otherwise, drives it over HTTP from a
+# separate thread and writes a JSON report that can be diffed across versions.
+os.environ.setdefault("INFERENCE_BACKEND", "mock")
+os.environ.setdefault("JOB_STORE", "memory")
+
+import httpx
+import uvicorn
+
+import main
+
+
+def summarize(values: List[float]) -> Dict[str, Optional[float]]:
+    if not values:
+        return {"count": 0, "mean": None, "p50": None, "p95": None, "p99": None, "max": None}
+    ordered = sorted(values)
+
+    def percentile(p: float) -> float:
+        return ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))]
+    return {
+        "count": len(ordered),
+        "mean": sum(ordered) / len(ordered),
+        "p50": percentile(50),
+        "p95": percentile(95),
+        "p99": percentile(99),
+        "max": ordered[-1],
+    }
+
+
+def arrival_offsets(pattern: str, jobs: int, rate: float, burst_size: int, seed: int) -> Iterator[float]:
+    # seconds after the start at which each job is submitted
+    rng = random.Random(seed)
+    offset = 0.0
+    for index in range(jobs):
+        if pattern == "poisson":
+            offset += rng.expovariate(rate)
+        elif pattern == "bursty":
+            # burst_size jobs at once, bursts spaced so the mean rate stays the same
+            if index and index % burst_size == 0:
+                offset += rng.expovariate(rate / burst_size)
+        else:
+            offset = 0.0
+        yield offset
+
+
+class LoopLagMonitor:
+    # How late a timer on the server's event loop fires, sampled every interval
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self.samples: List[float] = []
+        self._task: Optional[asyncio.Task] = None
+
+    async def _run(self):
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.samples.append(max(0.0, time.perf_counter() - start - self.interval))
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        self._task.cancel()
+
+
+class LoadGenerator:
+    def __init__(self, args: argparse.Namespace, base_url: str):
+        self.args = args
+        self.base_url = base_url
+        self.records: List[Dict[str, Any]] = []
+
+    def request_body(self, index: int) -> Dict[str, Any]:
+        # distinct questions so the result cache and coalescing do not short-circuit
+        variant = index % self.args.distinct if self.args.distinct else index
+        return {
+            "question_metadata": {"benchmark": True},
+            "question": f"benchmark question {variant}",
+            "organization_answer": "benchmark answer",
+            "priority": self.args.priority,
+        }
+
+    async def run_job(self, client: httpx.AsyncClient, index: int):
+        record: Dict[str, Any] = {"index": index}
+        start = time.perf_counter()
+        response = await client.post("/jobs", json=self.request_body(index))
+        record["submit_latency"] = time.perf_counter() - start
+        if response.status_code == 429:
+            record["status"] = "rejected"
+            self.records.append(record)
+            return
+        job_id = response.json()["job_id"]
+        while True:
+            job = (await client.get(f"/jobs/{job_id}", params={"wait": 30})).json()
+            if job["status"] in ("completed", "failed"):
+                break
+        record["status"] = job["status"]
+        record["queue_wait"] = job.get("timings", {}).get("queue_wait")
+        record["latency"] = time.perf_counter() - start
+        self.records.append(record)
+
+    async def run(self):
+        args = self.args
+        limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+        async with httpx.AsyncClient(base_url=self.base_url, timeout=None, limits=limits) as client:
+            if args.pattern == "closed":
+                # concurrency clients that each submit their next job once the last one finished
+                counter = iter(range(args.jobs))
+
+                async def worker():
+                    for index in counter:
+                        await self.run_job(client, index)
+                await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+                return
+            semaphore = asyncio.Semaphore(args.concurrency)
+
+            async def limited(index: int):
+                async with semaphore:
+                    await self.run_job(client, index)
+            start = time.perf_counter()
+            tasks = []
+            for index, offset in enumerate(arrival_offsets(args.pattern, args.jobs, args.rate, args.burst_size, args.seed)):
+                delay = start + offset - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                tasks.append(asyncio.create_task(limited(index)))
+            await asyncio.gather(*tasks)
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def benchmark(args: argparse.Namespace) -> Dict[str, Any]:
+    server = uvicorn.Server(uvicorn.Config(main.app, host="127.0.0.1", port=args.port, log_level="warning"))
+    serve = asyncio.create_task(server.serve())
+    while not server.started or main.backend_status == "loading":
+        await asyncio.sleep(0.05)
+    if main.backend_status != "ready":
+        raise RuntimeError(f"backend failed to load: {main.backend_error}")
+    lag = LoopLagMonitor()
+    lag.start()
+    generator = LoadGenerator(args, f"http://127.0.0.1:{args.port}")
+    start = time.perf_counter()
+    # the client gets its own thread and loop so it does not add to the server's lag
+    client = threading.Thread(target=asyncio.run, args=(generator.run(),), name="load-generator")
+    client.start()
+    while client.is_alive():
+        await asyncio.sleep(0.05)
+    elapsed = time.perf_counter() - start
+    lag.stop()
+    server.should_exit = True
+    await serve
+
+    records = generator.records
+    finished = [record for record in records if record["status"] in ("completed", "failed")]
+    queue_waits = [record["queue_wait"] for record in finished if record["queue_wait"] is not None]
+    return {
+        "revision": git_revision(),
+        "timestamp": datetime.now().isoformat(),
+        "config": {
+            **vars(args),
+            "backend": main.INFERENCE_BACKEND,
+            "max_batch_size": main.MAX_BATCH_SIZE,
+            "mock_prefill_ms": main.MOCK_PREFILL_MS,
+            "mock_tokens_per_second": main.MOCK_TOKENS_PER_SECOND,
+        },
+        "duration_seconds": elapsed,
+        "submitted": len(records),
+        "completed": sum(record["status"] == "completed" for record in records),
+        "failed": sum(record["status"] == "failed" for record in records),
+        "rejected": sum(record["status"] == "rejected" for record in records),
+        "throughput_jobs_per_second": len(finished) / elapsed if elapsed else None,
+        "latency_seconds": summarize([record["latency"] for record in finished]),
+        "submit_latency_seconds": summarize([record["submit_latency"] for record in records]),
+        "queue_wait_seconds": summarize(queue_waits),
+        "event_loop_lag_seconds": summarize(lag.samples),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test POST /jobs and GET /jobs/{job_id}")
+    parser.add_argument("--jobs", type=int, default=200, help="jobs to submit")
+    parser.add_argument("--pattern", choices=("poisson", "bursty", "closed", "all-at-once"), default="poisson")
+    parser.add_argument("--rate", type=float, default=10.0, help="mean arrivals per second for poisson/bursty")
+    parser.add_argument("--burst-size", type=int, default=20, help="jobs per burst for bursty")
+    parser.add_argument("--concurrency", type=int, default=64, help="max requests in flight (clients for closed)")
+    parser.add_argument("--distinct", type=int, default=0, help="cycle through this many distinct requests, 0 = all distinct")
+    parser.add_argument("--priority", choices=("interactive", "bulk"), default="interactive")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--output", help="JSON report path, defaults to benchmark-<timestamp>.json")
+    args = parser.parse_args()
+
+    report = asyncio.run(benchmark(args))
+    output = args.output or f"benchmark-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json"
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(json.dumps({key: report[key] for key in ("throughput_jobs_per_second", "latency_seconds", "queue_wait_seconds", "event_loop_lag_seconds")}, indent=2))
+    print(f"report written to {output}")
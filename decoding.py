@@ -0,0 +1,216 @@
+from typing import Dict, List
+
+import torch
+
+
+class OutputStopper:
+    # Ends a sequence once the XML answer is complete: on </output>, or on
+    # </score> when at least one </cause> was already written. Only the last
+    # few tokens are decoded per step and tags inside <think> are ignored.
+    def __init__(self, tokenizer, thinking: bool = True, window: int = 8):
+        self.tokenizer = tokenizer
+        self.window = window
+        self.answer_started = not thinking
+        self.seen_cause = False
+
+    def __call__(self, output_ids: List[int]) -> bool:
+        tail = self.tokenizer.decode(output_ids[-self.window:], skip_special_tokens=True)
+        if not self.answer_started:
+            if "</think>" not in tail:
+                return False
+            self.answer_started = True
+            tail = tail.split("</think>", 1)[1]
+        if "</cause>" in tail:
+            self.seen_cause = True
+        return "</output>" in tail or (self.seen_cause and "</score>" in tail)
+
+
+class ThinkingBudget:
+    # Logits processor that lets the model think for at most budget tokens
+    # and then forces "</think>" so decoding continues with the answer.
+    def __init__(self, tokenizer, budget: int):
+        self.budget = budget
+        self.end_id = tokenizer.convert_tokens_to_ids("</think>")
+        self.forced = tokenizer.encode("\n</think>\n\n", add_special_tokens=False)
+        self.cursor = 0
+        self.done = False
+
+    def __call__(self, output_ids: List[int], logits: torch.Tensor) -> torch.Tensor:
+        if self.done:
+            return logits
+        if self.cursor == 0:
+            if output_ids and output_ids[-1] == self.end_id:
+                self.done = True
+                return logits
+            if len(output_ids) < self.budget:
+                return logits
+        if self.cursor >= len(self.forced):
+            self.done = True
+            return logits
+        forced = torch.full_like(logits, float("-inf"))
+        forced[self.forced[self.cursor]] = 0
+        self.cursor += 1
+        return forced
+
+
+def count_thinking_tokens(tokenizer, output_ids: List[int], enable_thinking: bool = True) -> int:
+    if not enable_thinking:
+        return 0
+    end_id = tokenizer.convert_tokens_to_ids("</think>")
+    if end_id in output_ids:
+        return output_ids.index(end_id) + 1
+    # stopped before </think>, so everything generated was thinking
+    return len(output_ids)
+
+
+class XmlGrammar:
+    # Token-level finite-state grammar for the answer section:
+    #   <output><root_causes> 3-10 x <cause>text</cause> </root_causes>
+    #   <score>1..10</score></output>
+    # Fixed markup is emitted as the canonical tokenization of each literal,
+    # cause text may use any token without "<". Vocabulary masks are built
+    # once per logits size/device and shared by every sequence.
+    def __init__(self, tokenizer, min_causes: int = 3, max_causes: int = 10, max_preamble: int = 4):
+        self.tokenizer = tokenizer
+        self.min_causes = min_causes
+        self.max_causes = max_causes
+        self.max_preamble = max_preamble
+        self.think_end_id = tokenizer.convert_tokens_to_ids("</think>")
+        self.eos_id = tokenizer.eos_token_id
+        encode = lambda text: tokenizer.encode(text, add_special_tokens=False)
+        self.open = encode("<output>\n  <root_causes>\n    <cause>")
+        self.next_cause = encode("</cause>\n    <cause>")
+        self.close_causes = encode("</cause>\n  </root_causes>\n  <score>")
+        self.scores = [encode(f"{score}</score>\n</output>") for score in range(1, 11)]
+        self._masks: Dict[tuple, Dict[str, torch.Tensor]] = {}
+
+    def masks(self, size: int, device) -> Dict[str, torch.Tensor]:
+        key = (size, str(device))
+        if key not in self._masks:
+            vocab = len(self.tokenizer)
+            pieces = self.tokenizer.batch_decode([[idx] for idx in range(vocab)])
+            special = set(self.tokenizer.all_special_ids) | set(getattr(self.tokenizer, "added_tokens_decoder", {}))
+            text = torch.zeros(size, dtype=torch.bool)
+            space = torch.zeros(size, dtype=torch.bool)
+            for idx, piece in enumerate(pieces):
+                if idx in special:
+                    continue
+                text[idx] = "<" not in piece
+                space[idx] = piece != "" and piece.strip() == ""
+            self._masks[key] = {"text": text.to(device), "space": space.to(device)}
+        return self._masks[key]
+
+    def processor(self, thinking: bool = True) -> "XmlGrammarState":
+        return XmlGrammarState(self, thinking)
+
+
+class XmlGrammarState:
+    def __init__(self, grammar: XmlGrammar, thinking: bool):
+        self.grammar = grammar
+        self.mode = "think" if thinking else "preamble"
+        self.consumed = 0
+        self.preamble = 0
+        self.causes = 0
+        # literal alternatives being matched: (token ids, mode after it)
+        self.alive: List[tuple] = []
+        self.pos = 0
+
+    def _close_alternatives(self) -> List[tuple]:
+        alternatives = []
+        if self.causes + 1 < self.grammar.max_causes:
+            alternatives.append((self.grammar.next_cause, "cause"))
+        if self.causes + 1 >= self.grammar.min_causes:
+            alternatives.append((self.grammar.close_causes, "score"))
+        return alternatives
+
+    def _start_choice(self, alternatives: List[tuple]) -> None:
+        self.alive, self.pos = alternatives, 0
+
+    def _advance(self, token: int) -> None:
+        self.alive = [alt for alt in self.alive if alt[0][self.pos] == token]
+        self.pos += 1
+        if not self.alive:
+            # the sampled token left the grammar, stop constraining
+            self.mode = "free"
+            return
+        finished = next((alt for alt in self.alive if len(alt[0]) == self.pos), None)
+        if finished is None:
+            return
+        self.alive = []
+        if self.mode == "cause":
+            self.causes += 1
+        self.mode = finished[1]
+        if self.mode == "score":
+            self._start_choice([(tokens, "done") for tokens in self.grammar.scores])
+
+    def _consume(self, token: int) -> None:
+        if self.mode == "think":
+            if token == self.grammar.think_end_id:
+                self.mode = "preamble"
+        elif self.alive:
+            self._advance(token)
+        elif self.mode == "preamble":
+            if token == self.grammar.open[0]:
+                self._start_choice([(self.grammar.open, "cause")])
+                self._advance(token)
+            else:
+                self.preamble += 1
+        elif self.mode == "cause":
+            closing = self._close_alternatives()
+            if any(alt[0][0] == token for alt in closing):
+                self._start_choice(closing)
+                self._advance(token)
+
+    def __call__(self, output_ids: List[int], logits: torch.Tensor) -> torch.Tensor:
+        for token in output_ids[self.consumed:]:
+            self._consume(token)
+        self.consumed = len(output_ids)
+        if self.mode in ("think", "free"):
+            return logits
+        masks = self.grammar.masks(logits.shape[-1], logits.device)
+        if self.alive:
+            allowed = torch.zeros_like(masks["text"])
+            allowed[[alt[0][self.pos] for alt in self.alive]] = True
+        elif self.mode == "preamble":
+            allowed = masks["space"].clone() if self.preamble < self.grammar.max_preamble else torch.zeros_like(masks["space"])
+            allowed[self.grammar.open[0]] = True
+        elif self.mode == "cause":
+            allowed = masks["text"].clone()
+            allowed[[alt[0][0] for alt in self._close_alternatives()]] = True
+        else:
+            allowed = torch.zeros_like(masks["text"])
+            allowed[self.grammar.eos_id] = True
+        return logits.masked_fill(~allowed, float("-inf"))
+
+
+def chain_processors(*processors):
+    processors = [processor for processor in processors if processor is not None]
+    if len(processors) <= 1:
+        return processors[0] if processors else None
+
+    def apply(output_ids: List[int], logits: torch.Tensor) -> torch.Tensor:
+        for processor in processors:
+            logits = processor(output_ids, logits)
+        return logits
+    return apply
+
+
+class TextDeltaDecoder:
+    # Turns the growing list of generated ids into text deltas. Only the
+    # current line is re-decoded each call, and output is held back while
+    # it ends in a partial multi-byte character.
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+        self.line_start = 0
+        self.printed = 0
+
+    def __call__(self, output_ids: List[int]) -> str:
+        text = self.tokenizer.decode(output_ids[self.line_start:], skip_special_tokens=True)
+        if text.endswith("�"):
+            return ""
+        delta = text[self.printed:]
+        if text.endswith("\n"):
+            self.line_start, self.printed = len(output_ids), 0
+        else:
+            self.printed = len(text)
+        return delta
@@ -0,0 +1,281 @@
+import queue
+import sqlite3
+import threading
+import time
+from bisect import bisect_left, insort
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple, Type
+
+from pydantic import BaseModel
+
+
+class JobStore:
+    # Persistence behind the in-memory jobs dict. put() must not block the
+    # event loop; get()/unfinished() may, and are run off the loop by callers.
+    def put(self, job: BaseModel) -> None:
+        pass
+
+    def get(self, job_id: str) -> Optional[BaseModel]:
+        return None
+
+    def get_many(self, job_ids: List[str]) -> List[BaseModel]:
+        return []
+
+    def unfinished(self) -> List[BaseModel]:
+        return []
+
+    def page(self, status: Optional[str], before: Optional[Tuple[str, str]], limit: int) -> Optional[List[BaseModel]]:
+        # None: this store keeps no index to list from
+        return None
+
+    def committed(self, job_id: str) -> bool:
+        # True once every put() of the job so far can be read back
+        return True
+
+    def forget(self, job_id: str) -> None:
+        # the job left memory; stores that only index resident jobs drop it
+        pass
+
+    def close(self) -> None:
+        pass
+
+
+class MemoryJobStore(JobStore):
+    # Nothing survives a restart, but page() is served from sorted
+    # (created_at, job_id) indexes, one over all jobs and one per status,
+    # instead of sorting the jobs dict on every request. Jobs leave the
+    # indexes when they leave memory.
+    def __init__(self):
+        self._jobs: Dict[str, Tuple[Tuple[str, str], str, BaseModel]] = {}
+        self._all: List[Tuple[str, str]] = []
+        self._by_status: Dict[str, List[Tuple[str, str]]] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _remove(keys: List[Tuple[str, str]], key: Tuple[str, str]) -> None:
+        index = bisect_left(keys, key)
+        if index < len(keys) and keys[index] == key:
+            del keys[index]
+
+    def put(self, job: BaseModel) -> None:
+        key = (job.created_at.isoformat(), job.job_id)
+        with self._lock:
+            old = self._jobs.get(job.job_id)
+            if old is None:
+                insort(self._all, key)
+            elif old[1] != job.status:
+                self._remove(self._by_status[old[1]], key)
+            if old is None or old[1] != job.status:
+                insort(self._by_status.setdefault(job.status, []), key)
+            self._jobs[job.job_id] = (key, job.status, job)
+
+    def page(self, status: Optional[str], before: Optional[Tuple[str, str]], limit: int) -> Optional[List[BaseModel]]:
+        with self._lock:
+            keys = self._by_status.get(status, []) if status else self._all
+            end = bisect_left(keys, before) if before else len(keys)
+            return [self._jobs[job_id][2] for _, job_id in reversed(keys[max(0, end - limit):end])]
+
+    def forget(self, job_id: str) -> None:
+        with self._lock:
+            old = self._jobs.pop(job_id, None)
+            if old is not None:
+                self._remove(self._all, old[0])
+                self._remove(self._by_status[old[1]], old[0])
+
+
+class SQLiteJobStore(JobStore):
+    # WAL-mode SQLite table indexed on status and created_at. put() only
+    # serializes the job and hands it to a writer thread, which coalesces
+    # repeated writes of the same job and commits them in batches.
+    def __init__(self, path: str, model: Type[BaseModel], batch_size: int = 256, flush_interval: float = 0.05):
+        self.path = path
+        self.model = model
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "job_id TEXT PRIMARY KEY, status TEXT NOT NULL, created_at TEXT NOT NULL, "
+                "updated_at TEXT NOT NULL, data TEXT NOT NULL)"
+            )
+            # job_id breaks created_at ties so pages can resume from (created_at, job_id)
+            conn.execute("DROP INDEX IF EXISTS jobs_status")
+            conn.execute("DROP INDEX IF EXISTS jobs_created_at")
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_status_created ON jobs (status, created_at, job_id)")
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_created ON jobs (created_at, job_id)")
+        self._reader = self._connect()
+        self._reader_lock = threading.Lock()
+        # puts per job that the writer has not committed yet
+        self._unflushed: Dict[str, int] = {}
+        self._unflushed_lock = threading.Lock()
+        self._writes: "queue.Queue[Optional[tuple]]" = queue.Queue()
+        self._writer = threading.Thread(target=self._write_loop, name="job-store-writer", daemon=True)
+        self._writer.start()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def put(self, job: BaseModel) -> None:
+        with self._unflushed_lock:
+            self._unflushed[job.job_id] = self._unflushed.get(job.job_id, 0) + 1
+        self._writes.put((job.job_id, job.status, job.created_at.isoformat(), job.updated_at.isoformat(), job.model_dump_json()))
+
+    def _write_loop(self) -> None:
+        conn = self._connect()
+        while True:
+            item = self._writes.get()
+            if item is None:
+                break
+            batch: Dict[str, tuple] = {item[0]: item}
+            puts: Dict[str, int] = {item[0]: 1}
+            stop = False
+            while len(batch) < self.batch_size:
+                try:
+                    item = self._writes.get(timeout=self.flush_interval)
+                except queue.Empty:
+                    break
+                if item is None:
+                    stop = True
+                    break
+                batch[item[0]] = item
+                puts[item[0]] = puts.get(item[0], 0) + 1
+            try:
+                with conn:
+                    conn.executemany("INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, ?, ?)", list(batch.values()))
+            except sqlite3.Error as e:
+                print(f"failed to persist {len(batch)} jobs: {e}")
+            # failed writes are given up on too, they would never commit
+            with self._unflushed_lock:
+                for job_id, count in puts.items():
+                    remaining = self._unflushed[job_id] - count
+                    if remaining:
+                        self._unflushed[job_id] = remaining
+                    else:
+                        del self._unflushed[job_id]
+            if stop:
+                break
+        conn.close()
+
+    def committed(self, job_id: str) -> bool:
+        with self._unflushed_lock:
+            return job_id not in self._unflushed
+
+    def get(self, job_id: str) -> Optional[BaseModel]:
+        with self._reader_lock:
+            row = self._reader.execute("SELECT data FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        return self.model.model_validate_json(row[0]) if row else None
+
+    def get_many(self, job_ids: List[str]) -> List[BaseModel]:
+        rows = []
+        with self._reader_lock:
+            # stay under SQLite's default limit on bound parameters
+            for start in range(0, len(job_ids), 500):
+                chunk = job_ids[start:start + 500]
+                rows += self._reader.execute(
+                    f"SELECT data FROM jobs WHERE job_id IN ({','.join('?' * len(chunk))})", chunk
+                ).fetchall()
+        return [self.model.model_validate_json(row[0]) for row in rows]
+
+    def page(self, status: Optional[str], before: Optional[Tuple[str, str]], limit: int) -> Optional[List[BaseModel]]:
+        # newest first, keyset pagination on (created_at, job_id)
+        clauses, params = [], []
+        if status:
+            clauses.append("status = ?")
+            params.append(status)
+        if before:
+            clauses.append("(created_at, job_id) < (?, ?)")
+            params.extend(before)
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        with self._reader_lock:
+            rows = self._reader.execute(
+                f"SELECT data FROM jobs {where} ORDER BY created_at DESC, job_id DESC LIMIT ?", (*params, limit)
+            ).fetchall()
+        return [self.model.model_validate_json(row[0]) for row in rows]
+
+    def unfinished(self) -> List[BaseModel]:
+        with self._reader_lock:
+            rows = self._reader.execute(
+                "SELECT data FROM jobs WHERE status IN ('pending', 'processing') ORDER BY created_at"
+            ).fetchall()
+        return [self.model.model_validate_json(row[0]) for row in rows]
+
+    def close(self) -> None:
+        self._writes.put(None)
+        self._writer.join()
+        self._reader.close()
+
+
+class ResidentJobs:
+    # LRU bookkeeping for finished jobs kept in the in-memory jobs dict.
+    # Jobs leave memory once older than ttl seconds or when the resident
+    # count/bytes go over their caps; with a persistent store they can
+    # still be read back from disk afterwards. A job only leaves once the
+    # store has committed its latest write, so reads never go back in time.
+    def __init__(self, jobs: Dict[str, BaseModel], ttl: float, max_count: int, max_bytes: int,
+                 store: Optional[JobStore] = None):
+        self.jobs = jobs
+        self.store = store or JobStore()
+        self.ttl = ttl
+        self.max_count = max_count
+        self.max_bytes = max_bytes
+        self._sizes: "OrderedDict[str, int]" = OrderedDict()
+        self._finished_at: Dict[str, float] = {}
+        self.bytes = 0
+        self.evicted = 0
+
+    def add(self, job: BaseModel, size: Optional[int] = None) -> None:
+        # size: len(job.model_dump_json()) when the caller already has it
+        if size is None:
+            size = len(job.model_dump_json())
+        self.bytes += size - self._sizes.pop(job.job_id, 0)
+        self._sizes[job.job_id] = size
+        self._finished_at[job.job_id] = time.monotonic()
+        self._enforce_caps()
+
+    def touch(self, job_id: str) -> None:
+        if job_id in self._sizes:
+            self._sizes.move_to_end(job_id)
+
+    def _evict(self, job_id: str) -> None:
+        self.bytes -= self._sizes.pop(job_id)
+        del self._finished_at[job_id]
+        self.jobs.pop(job_id, None)
+        self.store.forget(job_id)
+        self.evicted += 1
+
+    def _enforce_caps(self) -> None:
+        count, nbytes = len(self._sizes), self.bytes
+        victims = []
+        # least recently used first, skipping jobs whose write is still queued
+        for job_id, size in self._sizes.items():
+            if count <= self.max_count and nbytes <= self.max_bytes:
+                break
+            if self.store.committed(job_id):
+                victims.append(job_id)
+                count -= 1
+                nbytes -= size
+        for job_id in victims:
+            self._evict(job_id)
+
+    def sweep(self) -> None:
+        cutoff = time.monotonic() - self.ttl
+        for job_id in [
+            job_id for job_id, finished in self._finished_at.items()
+            if finished < cutoff and self.store.committed(job_id)
+        ]:
+            self._evict(job_id)
+        # retry cap evictions that waited on the writer
+        self._enforce_caps()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "resident_jobs": len(self.jobs),
+            "resident_finished_jobs": len(self._sizes),
+            "resident_finished_bytes": self.bytes,
+            "max_finished_jobs": self.max_count,
+            "max_finished_bytes": self.max_bytes,
+            "evicted": self.evicted,
+        }
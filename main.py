@@ -1,13 +1,30 @@
-from fastapi import FastAPI, Request, BackgroundTasks
-from unsloth import FastLanguageModel
-import torch
+import os
+if os.environ.get("INFERENCE_BACKEND", "unsloth") == "unsloth":
+    import unsloth  # patches transformers, so it has to come first
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 import uvicorn
-from pydantic import BaseModel
-from typing import Dict, Any, Optional
+from pydantic import BaseModel, Field, TypeAdapter, ValidationError
+from typing import Dict, Any, List, Literal, Optional
 import re
+import json
+import base64
+import argparse
+import math
+import time
+import threading
+from collections import deque
 import asyncio
 from uuid import uuid4
 from datetime import datetime
+from backends import InferenceBackend, MockBackend, UnslothBackend
+from batching import Sequence
+from queueing import JobQueue
+from job_store import JobStore, MemoryJobStore, ResidentJobs, SQLiteJobStore
+from result_cache import ResultCache, cache_key
+from batch_runner import run_jsonl
+from metrics import MetricsRegistry, labels
+from decoding import OutputStopper, TextDeltaDecoder, ThinkingBudget, XmlGrammar, chain_processors, count_thinking_tokens
 
 app = FastAPI()
 SYSTEM_PROMPT = """شما یک ارزیاب متخصص بلوغ دیجیتال هستید. وظیفه شما تحلیل پاسخ‌های سازمان‌ها به سوالات ارزیابی بلوغ دیجیتال و ارائه تحلیل عمیق در قالب XML است.
@@ -36,44 +53,540 @@ class analysisRequest(BaseModel):
     question_metadata: Dict[str, Any]      # Enforces a JSON object/dictionary
     question: str                 # Enforces a string
     organization_answer: str      # Enforces a string
+    enable_thinking: bool = True  # False skips the <think> section entirely
+    thinking_budget: Optional[int] = Field(None, ge=0)  # Max thinking tokens, server default when unset
+    constrained_output: Optional[bool] = None  # Force the <output> XML schema, server default when unset
+    priority: Literal["interactive", "bulk"] = "interactive"  # Bulk jobs only run when no interactive job waits
+    bypass_cache: bool = False  # Always sample a fresh answer instead of reusing a cached one
 
 class Job(BaseModel):
     job_id: str
     status: str  # pending, processing, completed, failed
     request: analysisRequest
+    tenant: str = "default"
+    coalesced_with: Optional[str] = None  # in-flight job this duplicate is completed from
+    batch_id: Optional[str] = None
+    timings: Optional[Dict[str, float]] = None  # seconds spent in each stage
     result: Optional[Dict[str, Any]] = None
     error: Optional[str] = None
     created_at: datetime
     updated_at: datetime
 
-# 1. Load base model (4-bit quantized for A100 efficiency)
-model, tokenizer = FastLanguageModel.from_pretrained(
-    model_name = "unsloth/Qwen3-32B",  # Or use "Qwen/Qwen3-32B" to download from HF
-    max_seq_length = 2048,
-    load_in_4bit = True,
-    load_in_8bit = False,
-    dtype = None,  
-    cache_dir = "/workspace/Qwen3-32B"
-)
+class Batch(BaseModel):
+    batch_id: str
+    job_ids: List[str]  # in submission order
+    completed: int = 0
+    failed: int = 0
+    created_at: datetime
+    updated_at: datetime
+
+class JobStatusRequest(BaseModel):
+    job_ids: List[str]
 
-# 2. Apply chat template correctly for Qwen3
-FastLanguageModel.for_inference(model)
+batch_requests_adapter = TypeAdapter(List[analysisRequest])
+
+# "unsloth" serves the real model, "mock" replays a canned answer at a
+# simulated speed so the API and scheduler can be exercised on CPU
+INFERENCE_BACKEND = os.environ.get("INFERENCE_BACKEND", "unsloth")
+MOCK_PREFILL_MS = float(os.environ.get("MOCK_PREFILL_MS", "50"))
+MOCK_TOKENS_PER_SECOND = float(os.environ.get("MOCK_TOKENS_PER_SECOND", "30"))
+# Maximum number of sequences decoded together by the batcher
+MAX_BATCH_SIZE = int(os.environ.get("MAX_BATCH_SIZE", "8"))
+# "continuous" admits jobs into the running decode batch, "static" groups
+# jobs of similar prompt length and runs one model.generate per group
+BATCHING_MODE = os.environ.get("BATCHING_MODE", "continuous")
+BATCH_WAIT_MS = float(os.environ.get("BATCH_WAIT_MS", "50"))
+BATCH_BUCKET_TOKENS = int(os.environ.get("BATCH_BUCKET_TOKENS", "128"))
+# GPU memory kept for cached prompt prefixes (system + metadata + question)
+PREFIX_CACHE_MAX_MB = int(os.environ.get("PREFIX_CACHE_MAX_MB", "4096"))
+PREFIX_CACHE_BLOCK_TOKENS = int(os.environ.get("PREFIX_CACHE_BLOCK_TOKENS", "32"))
+# Default cap on <think> tokens, unset means the model thinks until it stops
+THINKING_BUDGET = int(os.environ["THINKING_BUDGET"]) if os.environ.get("THINKING_BUDGET") else None
+# Mask logits to the <output> XML schema once thinking is over
+CONSTRAINED_DECODING = os.environ.get("CONSTRAINED_DECODING", "0") == "1"
+# Upper bound for the ?wait= long-poll on GET /jobs/{job_id}
+LONG_POLL_MAX_SECONDS = float(os.environ.get("LONG_POLL_MAX_SECONDS", "60"))
+# Backpressure: POST /jobs answers 429 once either limit would be exceeded
+MAX_QUEUE_DEPTH = int(os.environ.get("MAX_QUEUE_DEPTH", "1000"))
+MAX_QUEUED_TOKENS = int(os.environ.get("MAX_QUEUED_TOKENS", "2000000"))
+# POST /jobs/batch has its own limits so a large assessment is neither
+# turned away by the single-job limits nor crowds out single submissions
+MAX_BATCH_QUEUE_DEPTH = int(os.environ.get("MAX_BATCH_QUEUE_DEPTH", "100000"))
+MAX_BATCH_QUEUED_TOKENS = int(os.environ.get("MAX_BATCH_QUEUED_TOKENS", "300000000"))
+# Fair share between tenants, identified by the X-Tenant-ID header or this
+# question_metadata key. TENANT_WEIGHTS looks like "org-a=2,org-b=0.5".
+TENANT_METADATA_KEY = os.environ.get("TENANT_METADATA_KEY", "organization_id")
+TENANT_WEIGHTS = {
+    name.strip(): float(weight)
+    for name, weight in (item.split("=") for item in os.environ.get("TENANT_WEIGHTS", "").split(",") if item)
+}
+# Max jobs of one tenant in the running batch, 0 disables the cap
+TENANT_MAX_CONCURRENCY = int(os.environ.get("TENANT_MAX_CONCURRENCY", "0"))
+# "sqlite" keeps jobs across restarts and re-queues unfinished ones, "memory" does not
+JOB_STORE = os.environ.get("JOB_STORE", "sqlite")
+JOB_STORE_PATH = os.environ.get("JOB_STORE_PATH", "jobs.db")
+# Finished jobs kept in memory; older or least recently read ones are
+# dropped and, with the sqlite store, served from disk instead
+JOB_RETENTION_SECONDS = float(os.environ.get("JOB_RETENTION_SECONDS", "86400"))
+MAX_RESIDENT_JOBS = int(os.environ.get("MAX_RESIDENT_JOBS", "10000"))
+MAX_RESIDENT_MB = int(os.environ.get("MAX_RESIDENT_MB", "512"))
+# Results of identical requests are reused; RESULT_CACHE_PATH adds a disk tier
+RESULT_CACHE_SIZE = int(os.environ.get("RESULT_CACHE_SIZE", "10000"))
+RESULT_CACHE_PATH = os.environ.get("RESULT_CACHE_PATH") or None
+RESULT_CACHE_DISK_ENTRIES = int(os.environ.get("RESULT_CACHE_DISK_ENTRIES", "1000000"))
+# Duplicates of a queued or running job attach to it instead of generating again
+COALESCE_DUPLICATES = os.environ.get("COALESCE_DUPLICATES", "1") == "1"
+# Shapes run through the model after loading, before /health/ready says ready
+WARMUP = os.environ.get("WARMUP", "1") == "1"
+WARMUP_PROMPT_TOKENS = [int(tokens) for tokens in os.environ.get("WARMUP_PROMPT_TOKENS", "512,1536").split(",") if tokens]
+WARMUP_BATCH_SIZES = [int(size) for size in os.environ.get("WARMUP_BATCH_SIZES", f"1,{MAX_BATCH_SIZE}").split(",") if size]
+WARMUP_DECODE_TOKENS = int(os.environ.get("WARMUP_DECODE_TOKENS", "16"))
+GENERATION_KWARGS = dict(max_new_tokens=2048, temperature=0.6, top_p=0.9, top_k=20)
+
+if INFERENCE_BACKEND == "mock":
+    backend: InferenceBackend = MockBackend(
+        prefill_ms=MOCK_PREFILL_MS,
+        tokens_per_second=MOCK_TOKENS_PER_SECOND,
+        max_batch_size=MAX_BATCH_SIZE,
+        generation_kwargs=GENERATION_KWARGS
+    )
+else:
+    backend = UnslothBackend(
+        model_name="unsloth/Qwen3-32B",  # Or use "Qwen/Qwen3-32B" to download from HF
+        cache_dir="/workspace/Qwen3-32B",
+        system_prompt=SYSTEM_PROMPT,
+        batching_mode=BATCHING_MODE,
+        max_batch_size=MAX_BATCH_SIZE,
+        batch_wait_ms=BATCH_WAIT_MS,
+        bucket_tokens=BATCH_BUCKET_TOKENS,
+        prefix_cache_bytes=PREFIX_CACHE_MAX_MB << 20,
+        prefix_block_tokens=PREFIX_CACHE_BLOCK_TOKENS,
+        generation_kwargs=GENERATION_KWARGS
+    )
+# Set by load_backend(); the server accepts and queues jobs while the model
+# loads in the background and only starts generating once it is ready
+tokenizer = None
+xml_grammar: Optional[XmlGrammar] = None
+backend_status = "loading"  # loading, ready, failed
+backend_error: Optional[str] = None
+backend_lock = threading.Lock()
+warmup_report: Optional[Dict[str, Any]] = None
+
+def load_backend():
+    global tokenizer, xml_grammar
+    with backend_lock:
+        if xml_grammar is not None:
+            return
+        backend.load()
+        tokenizer = backend.tokenizer
+        xml_grammar = XmlGrammar(tokenizer)
 
 # Global storage for jobs
+job_store: JobStore = SQLiteJobStore(JOB_STORE_PATH, Job) if JOB_STORE == "sqlite" else MemoryJobStore()
 jobs: Dict[str, Job] = {}
-job_queue: list = []
-current_job_id: Optional[str] = None
+result_cache = ResultCache(RESULT_CACHE_SIZE, RESULT_CACHE_PATH, RESULT_CACHE_DISK_ENTRIES)
+resident_jobs = ResidentJobs(jobs, JOB_RETENTION_SECONDS, MAX_RESIDENT_JOBS, MAX_RESIDENT_MB << 20, job_store)
+job_queue = JobQueue(("interactive", "bulk"), weights=TENANT_WEIGHTS)
+running_jobs: set = set()
+running_by_tenant: Dict[str, int] = {}
+job_streams: Dict[str, "JobStream"] = {}
+# Cache key -> job generating it, and the duplicate jobs waiting on each one
+inflight_jobs: Dict[str, str] = {}
+job_followers: Dict[str, List[str]] = {}
+batches: Dict[str, Batch] = {}
+# Set when a job reaches completed/failed, used by long-polling readers
+job_done_events: Dict[str, asyncio.Event] = {}
+
+# Estimated prompt + completion tokens of every queued job
+job_costs: Dict[str, int] = {}
+queued_tokens = 0
+# Queued jobs and tokens per admission pool, checked against its own limits:
+# "jobs" for POST /jobs, "batches" for POST /jobs/batch
+pool_limits = {"jobs": (MAX_QUEUE_DEPTH, MAX_QUEUED_TOKENS), "batches": (MAX_BATCH_QUEUE_DEPTH, MAX_BATCH_QUEUED_TOKENS)}
+pool_depth = {"jobs": 0, "batches": 0}
+pool_tokens = {"jobs": 0, "batches": 0}
+
+def queue_pool(job: Job) -> str:
+    return "batches" if job.batch_id else "jobs"
+
+class ThroughputMeter:
+    # Completed jobs and tokens over a sliding window, used for Retry-After
+    def __init__(self, window: float = 60.0):
+        self.window = window
+        self.samples: deque = deque()
+
+    def record(self, prompt_tokens: int, completion_tokens: int):
+        self.samples.append((time.monotonic(), prompt_tokens, completion_tokens))
+        self.prune()
+
+    def prune(self):
+        # readers prune too, so an idle spell does not leave stale samples
+        cutoff = time.monotonic() - self.window
+        while self.samples and self.samples[0][0] < cutoff:
+            self.samples.popleft()
+
+    def rates(self) -> Optional[tuple]:
+        self.prune()
+        if not self.samples:
+            return None
+        span = max(time.monotonic() - self.samples[0][0], 1.0)
+        tokens = sum(prompt + completion for _, prompt, completion in self.samples)
+        return len(self.samples) / span, tokens / span
+
+    def average_completion_tokens(self) -> int:
+        self.prune()
+        if not self.samples:
+            return GENERATION_KWARGS["max_new_tokens"]
+        return int(sum(completion for _, _, completion in self.samples) / len(self.samples))
+
+throughput = ThroughputMeter()
+
+metrics = MetricsRegistry()
+metrics.gauge("analysis_queue_depth", "Jobs waiting in the queue", lambda: {
+    labels(priority=priority): job_queue.depth(priority) for priority in ("interactive", "bulk")
+})
+metrics.gauge("analysis_queued_tokens", "Estimated tokens of the queued jobs", lambda: queued_tokens)
+metrics.gauge("analysis_jobs", "Jobs not finished yet", lambda: {
+    labels(status="pending"): len(job_queue),
+    labels(status="processing"): len(running_jobs),
+})
+metrics.gauge("analysis_tokens_per_second", "Prompt + generated tokens per second over the last minute",
+              lambda: (throughput.rates() or (0, 0))[1])
+jobs_finished = metrics.counter("analysis_jobs_finished_total", "Jobs that ran on the model, by final status")
+jobs_deduplicated = metrics.counter("analysis_jobs_deduplicated_total", "Jobs answered without generating, by source")
+parse_failures = metrics.counter("analysis_parse_failures_total", "Outputs without a score or causes")
+prompt_tokens_total = metrics.counter("analysis_prompt_tokens_total", "Prompt tokens prefilled")
+generated_tokens_total = metrics.counter("analysis_generated_tokens_total", "Tokens generated")
+queue_wait_seconds = metrics.histogram(
+    "analysis_queue_wait_seconds", "Time from submission until a job starts generating",
+    (0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+)
+generation_seconds = metrics.histogram(
+    "analysis_generation_seconds", "Time spent generating one job or one sync batch",
+    (0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300)
+)
+time_to_first_token_seconds = metrics.histogram(
+    "analysis_time_to_first_token_seconds", "Time from handing a job to the backend until its first token",
+    (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+)
+metrics.gauge("analysis_resident_jobs", "Jobs held in memory", lambda: resident_jobs.stats()["resident_jobs"])
+metrics.gauge("analysis_resident_finished_jobs", "Finished jobs held in memory",
+              lambda: resident_jobs.stats()["resident_finished_jobs"])
+metrics.gauge("analysis_resident_finished_bytes", "Serialized size of the finished jobs held in memory",
+              lambda: resident_jobs.stats()["resident_finished_bytes"])
+metrics.callback_counter("analysis_resident_jobs_evicted_total", "Finished jobs dropped from memory",
+                         lambda: resident_jobs.stats()["evicted"])
+metrics.gauge("analysis_result_cache_entries", "Results held in the in-memory result cache",
+              lambda: result_cache.stats()["memory_entries"])
+metrics.callback_counter("analysis_result_cache_lookups_total", "Result cache lookups by outcome", lambda: {
+    labels(result=result): result_cache.stats()[key]
+    for result, key in (("memory_hit", "hits"), ("disk_hit", "disk_hits"), ("miss", "misses"))
+})
+
+def prefix_cache_stat(key: str):
+    # the mock backend has no prefix cache and reports nothing
+    def read():
+        value = backend.prefix_cache_stats().get(key)
+        return {} if value is None else {(): value}
+    return read
+
+metrics.gauge("analysis_prefix_cache_blocks", "KV blocks held in the prefix cache", prefix_cache_stat("blocks"))
+metrics.gauge("analysis_prefix_cache_bytes", "GPU memory held by the prefix cache", prefix_cache_stat("bytes"))
+metrics.callback_counter("analysis_prefix_cache_lookups_total", "Prompts looked up in the prefix cache",
+                         prefix_cache_stat("lookups"))
+metrics.callback_counter("analysis_prefix_cache_hits_total", "Prompts that reused a cached prefix",
+                         prefix_cache_stat("hits"))
+metrics.callback_counter("analysis_prefix_cache_lookup_tokens_total", "Prompt tokens looked up in the prefix cache",
+                         prefix_cache_stat("lookup_tokens"))
+metrics.callback_counter("analysis_prefix_cache_hit_tokens_total", "Prompt tokens served from cached KV",
+                         prefix_cache_stat("hit_tokens"))
+metrics.callback_counter("analysis_prefix_cache_bytes_saved_total", "Bytes of KV reused instead of recomputed",
+                         prefix_cache_stat("bytes_saved"))
+metrics.callback_counter("analysis_prefix_cache_evictions_total", "KV blocks evicted from the prefix cache",
+                         prefix_cache_stat("evictions"))
+
+def estimate_job_tokens(request: analysisRequest) -> int:
+    return estimate_batch_tokens([request])[0]
+
+def estimate_batch_tokens(requests: List[analysisRequest]) -> List[int]:
+    completion_tokens = throughput.average_completion_tokens()
+    if tokenizer is None:
+        # model still loading: about three characters per token
+        return [
+            (len(SYSTEM_PROMPT) + len(str(request.question_metadata)) + len(request.question) + len(request.organization_answer)) // 3
+            + completion_tokens
+            for request in requests
+        ]
+    prompts = tokenizer([build_prompt(request) for request in requests]).input_ids
+    return [len(prompt) + completion_tokens for prompt in prompts]
+
+def retry_after_seconds(cost: int, count: int = 1, pool: str = "jobs") -> Optional[int]:
+    # None when the jobs fit, otherwise how long until the pool has drained enough
+    max_depth, max_tokens = pool_limits[pool]
+    excess_jobs = pool_depth[pool] + count - max_depth
+    excess_tokens = pool_tokens[pool] + cost - max_tokens
+    if excess_jobs <= 0 and excess_tokens <= 0:
+        return None
+    rates = throughput.rates()
+    if rates is None:
+        return 5
+    jobs_per_second, tokens_per_second = rates
+    wait = max(excess_jobs / jobs_per_second, excess_tokens / tokens_per_second)
+    return min(max(math.ceil(wait), 1), 300)
+
+CAUSE_PATTERN = re.compile(r"<cause>(.*?)</cause>", re.DOTALL)
+
+class JobStream:
+    # Fans generated text out to the SSE subscribers of one job and emits
+    # each cause as soon as its closing tag arrives
+    def __init__(self, thinking: bool):
+        self.text = ""
+        self.causes: List[str] = []
+        self.subscribers: List[asyncio.Queue] = []
+        self.answer_start = None if thinking else 0
+        # final job_response, kept for subscribers that arrive after it
+        self.done: Optional[Dict[str, Any]] = None
+
+    def subscribe(self) -> asyncio.Queue:
+        queue = asyncio.Queue()
+        # late subscribers first get everything generated so far
+        if self.text:
+            queue.put_nowait(("token", {"text": self.text}))
+        for index, cause in enumerate(self.causes):
+            queue.put_nowait(("cause", {"index": index, "cause": cause}))
+        if self.done is not None:
+            queue.put_nowait(("done", self.done))
+        self.subscribers.append(queue)
+        return queue
+
+    def publish(self, event: str, data: Dict[str, Any]):
+        if event == "done":
+            self.done = data
+        for queue in self.subscribers:
+            queue.put_nowait((event, data))
+
+    def push_text(self, delta: str):
+        self.text += delta
+        self.publish("token", {"text": delta})
+        if self.answer_start is None:
+            end = self.text.find("</think>")
+            if end == -1:
+                return
+            self.answer_start = end + len("</think>")
+        for match in CAUSE_PATTERN.finditer(self.text, self.answer_start):
+            cause = match.group(1).strip()
+            self.publish("cause", {"index": len(self.causes), "cause": cause})
+            self.causes.append(cause)
+            self.answer_start = match.end()
+
+@app.on_event("startup")
+async def start_backend():
+    async def load():
+        global backend_status, backend_error, warmup_report
+        started = time.monotonic()
+        try:
+            await asyncio.to_thread(load_backend)
+        except Exception as e:
+            backend_status, backend_error = "failed", f"{type(e).__name__}: {e}"
+            print(f"loading the model failed: {backend_error}")
+            return
+        backend.start()
+        if WARMUP:
+            try:
+                warmup_report = await asyncio.to_thread(run_warmup)
+                print(f"warmup took {warmup_report['seconds']}s over {len(warmup_report['shapes'])} shapes")
+            except Exception as e:
+                # serve anyway, the first requests just pay the warmup cost
+                warmup_report = {"error": f"{type(e).__name__}: {e}"}
+                print(f"warmup failed: {warmup_report['error']}")
+        backend_status = "ready"
+        print(f"model ready after {time.monotonic() - started:.1f}s")
+        # run whatever was queued while loading
+        schedule_jobs()
+    asyncio.create_task(load())
+
+def warmup_prompt(tokens: int, index: int) -> str:
+    # a real prompt padded to about `tokens`; the index keeps prompts of one
+    # batch from sharing a prefix beyond the system turn
+    request = analysisRequest(question_metadata={}, question=f"warmup {index}", organization_answer="")
+    missing = tokens - len(tokenizer(build_prompt(request)).input_ids)
+    if missing > 0:
+        per_filler = len(tokenizer(" ok" * 16).input_ids) / 16
+        request.organization_answer = " ok" * int(missing / per_filler)
+    return build_prompt(request)
+
+def run_warmup() -> Dict[str, Any]:
+    # Runs every batch size x prompt length through the serving batcher so
+    # kernels are compiled and allocator pools have grown before real
+    # traffic. Decode runs on a growing dynamic KV cache, so there is no
+    # fixed shape to capture CUDA graphs for.
+    started = time.monotonic()
+    shapes = []
+    for batch_size in sorted({min(size, MAX_BATCH_SIZE) for size in WARMUP_BATCH_SIZES}):
+        for tokens in sorted(WARMUP_PROMPT_TOKENS):
+            shape_started = time.monotonic()
+            done = threading.Semaphore(0)
+            seqs = [
+                backend.submit(warmup_prompt(tokens, index), lambda seq: done.release(), max_new_tokens=WARMUP_DECODE_TOKENS)
+                for index in range(batch_size)
+            ]
+            for _ in seqs:
+                done.acquire()
+            errors = [seq.error for seq in seqs if seq.error is not None]
+            if errors:
+                raise RuntimeError(errors[0])
+            shapes.append({
+                "batch_size": batch_size,
+                "prompt_tokens": max(len(seq.prompt_ids) for seq in seqs),
+                "decode_tokens": max(len(seq.output_ids) for seq in seqs),
+                "seconds": round(time.monotonic() - shape_started, 3),
+            })
+    return {"seconds": round(time.monotonic() - started, 3), "shapes": shapes, "cuda_graphs": False}
+
+@app.get("/health/live")
+async def health_live():
+    return {"status": "alive"}
+
+@app.get("/health/ready")
+async def health_ready():
+    if backend_status != "ready":
+        return JSONResponse(status_code=503, content={"status": backend_status, "error": backend_error})
+    return {"status": "ready", "warmup": warmup_report}
+
+def tenant_has_capacity(tenant: str) -> bool:
+    return not TENANT_MAX_CONCURRENCY or running_by_tenant.get(tenant, 0) < TENANT_MAX_CONCURRENCY
+
+def schedule_jobs():
+    global queued_tokens
+    # Hand queued jobs to the batcher while it has free slots
+    if backend_status != "ready":
+        return
+    while job_queue and len(running_jobs) < MAX_BATCH_SIZE:
+        next_job_id = job_queue.pop(tenant_has_capacity)
+        if next_job_id is None:
+            break
+        cost = job_costs.pop(next_job_id, 0)
+        pool = queue_pool(jobs[next_job_id])
+        queued_tokens -= cost
+        pool_depth[pool] -= 1
+        pool_tokens[pool] -= cost
+        tenant = jobs[next_job_id].tenant
+        running_by_tenant[tenant] = running_by_tenant.get(tenant, 0) + 1
+        running_jobs.add(next_job_id)
+        asyncio.create_task(process_job(next_job_id))
+
+def request_cache_key(request: analysisRequest) -> str:
+    # everything that changes the prompt or how it is decoded
+    return cache_key({
+        "question_metadata": request.question_metadata,
+        "question": request.question,
+        "organization_answer": request.organization_answer,
+        "enable_thinking": request.enable_thinking,
+        "thinking_budget": request.thinking_budget if request.thinking_budget is not None else THINKING_BUDGET,
+        "constrained_output": request.constrained_output if request.constrained_output is not None else CONSTRAINED_DECODING,
+    })
+
+def is_complete_result(result: Dict[str, Any]) -> bool:
+    # parse failures are not cached so a retry gets a fresh sample
+    return bool(result["root_causes"]) and not result["answer_score"].startswith("Error")
+
+async def lookup_cached_result(request: analysisRequest) -> Optional[Dict[str, Any]]:
+    return (await lookup_cached_results([request]))[0]
+
+async def lookup_cached_results(requests: List[analysisRequest]) -> List[Optional[Dict[str, Any]]]:
+    results: List[Optional[Dict[str, Any]]] = [None] * len(requests)
+    if not result_cache.enabled:
+        return results
+    keys = {}
+    for index, request in enumerate(requests):
+        if request.bypass_cache:
+            continue
+        keys[index] = request_cache_key(request)
+        results[index] = result_cache.get_memory(keys[index])
+    misses = [index for index in keys if results[index] is None]
+    if misses:
+        # one executor hop for all disk lookups
+        loop = asyncio.get_running_loop()
+        found = await loop.run_in_executor(None, lambda: [result_cache.get(keys[index]) for index in misses])
+        for index, result in zip(misses, found):
+            results[index] = result
+    hits = sum(result is not None for result in results)
+    if hits:
+        jobs_deduplicated.inc(hits, source="cache")
+    return [dict(result, cached=True) if result is not None else None for result in results]
+
+def decoding_controls(request: analysisRequest) -> Dict[str, Any]:
+    budget = request.thinking_budget if request.thinking_budget is not None else THINKING_BUDGET
+    constrained = request.constrained_output if request.constrained_output is not None else CONSTRAINED_DECODING
+    return {
+        "stop": OutputStopper(tokenizer, thinking=request.enable_thinking),
+        "logits_processor": chain_processors(
+            ThinkingBudget(tokenizer, budget) if request.enable_thinking and budget is not None else None,
+            xml_grammar.processor(thinking=request.enable_thinking) if constrained else None,
+        ),
+    }
+
+async def generate(request: analysisRequest, stream: Optional[JobStream] = None) -> Sequence:
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+    decoder = TextDeltaDecoder(tokenizer) if stream is not None else None
+    template_start = time.monotonic()
+    prompt = build_prompt(request)
+    submitted_at = time.monotonic()
+    first_token_at = None
+
+    def on_token(output_ids):
+        nonlocal first_token_at
+        if first_token_at is None:
+            first_token_at = time.monotonic()
+        if decoder is not None:
+            delta = decoder(output_ids)
+            if delta:
+                loop.call_soon_threadsafe(stream.push_text, delta)
+
+    backend.submit(
+        prompt,
+        lambda seq: loop.call_soon_threadsafe(future.set_result, seq),
+        on_token=on_token,
+        **decoding_controls(request)
+    )
+    seq = await future
+    seq.timings.update(template_start=template_start, template_end=submitted_at)
+    generation_seconds.observe(time.monotonic() - submitted_at)
+    if first_token_at is not None:
+        time_to_first_token_seconds.observe(first_token_at - submitted_at)
+    prompt_tokens_total.inc(len(seq.prompt_ids))
+    generated_tokens_total.inc(len(seq.output_ids))
+    if seq.error is not None:
+        raise RuntimeError(seq.error)
+    return seq
 
 async def process_job(job_id: str):
-    global current_job_id, job_queue
     try:
         # Update status to processing
         jobs[job_id].status = "processing"
         jobs[job_id].updated_at = datetime.now()
+        job_store.put(jobs[job_id])
+        queue_wait = (jobs[job_id].updated_at - jobs[job_id].created_at).total_seconds()
+        queue_wait_seconds.observe(queue_wait)
+        jobs[job_id].timings = {"queue_wait": queue_wait}
+        for follower_id in job_followers.get(job_id, []):
+            jobs[follower_id].status = "processing"
+            job_store.put(jobs[follower_id])
 
-        # Run the model generation in a thread
-        loop = asyncio.get_event_loop()
-        result = await loop.run_in_executor(None, sync_process_request, jobs[job_id].request)
+        request = jobs[job_id].request
+        seq = await generate(request, job_streams.get(job_id))
+
+        seq.mark("parse_start")
+        result = parse_model_output(request, seq.text)
+        seq.mark("parsed")
+        result["generation"] = generation_info(request, seq)
+        jobs[job_id].timings.update(stage_timings(seq))
+        throughput.record(len(seq.prompt_ids), len(seq.output_ids))
+        if not is_complete_result(result):
+            parse_failures.inc()
+        elif result_cache.enabled:
+            asyncio.get_running_loop().run_in_executor(None, result_cache.put, request_cache_key(request), result)
 
         # Update job with result
         jobs[job_id].status = "completed"
@@ -85,41 +598,114 @@ async def process_job(job_id: str):
         jobs[job_id].error = str(e)
         jobs[job_id].updated_at = datetime.now()
     finally:
-        current_job_id = None
-        # Start next job if any
-        if job_queue:
-            next_job_id = job_queue.pop(0)
-            current_job_id = next_job_id
-            asyncio.create_task(process_job(next_job_id))
+        job = jobs[job_id]
+        job_store.put(job)
+        jobs_finished.inc(status=job.status)
+        key = request_cache_key(job.request)
+        if inflight_jobs.get(key) == job_id:
+            del inflight_jobs[key]
+        finish_followers(job)
+        stream = job_streams.pop(job_id, None)
+        if stream is not None:
+            stream.publish("done", job_response(job))
+        done_event = job_done_events.pop(job_id, None)
+        if done_event is not None:
+            done_event.set()
+        record_batch_progress(job)
+        running_jobs.discard(job_id)
+        running_by_tenant[job.tenant] -= 1
+        if not running_by_tenant[job.tenant]:
+            del running_by_tenant[job.tenant]
+        resident_jobs.add(job)
+        # Start next jobs if any
+        schedule_jobs()
 
-def sync_process_request(request: analysisRequest) -> Dict[str, Any]:
+def attach_to_inflight(job: Job, key: Optional[str] = None) -> bool:
+    # single-flight: a duplicate of an in-flight job waits for its result
+    if not COALESCE_DUPLICATES or job.request.bypass_cache:
+        return False
+    leader_id = inflight_jobs.get(key or request_cache_key(job.request))
+    if leader_id is None:
+        return False
+    job.coalesced_with = leader_id
+    job.status = jobs[leader_id].status
+    jobs[job.job_id] = job
+    job_followers.setdefault(leader_id, []).append(job.job_id)
+    jobs_deduplicated.inc(source="coalesced")
+    if leader_id in job_streams:
+        job_streams[job.job_id] = job_streams[leader_id]
+    job_done_events[job.job_id] = asyncio.Event()
+    return True
+
+def finish_followers(leader: Job):
+    for follower_id in job_followers.pop(leader.job_id, []):
+        follower = jobs[follower_id]
+        follower.status = leader.status
+        follower.result = leader.result
+        follower.error = leader.error
+        follower.updated_at = leader.updated_at
+        job_store.put(follower)
+        job_streams.pop(follower_id, None)
+        done_event = job_done_events.pop(follower_id, None)
+        if done_event is not None:
+            done_event.set()
+        resident_jobs.add(follower)
+        record_batch_progress(follower)
+
+def record_batch_progress(job: Job):
+    batch = batches.get(job.batch_id) if job.batch_id else None
+    if batch is None:
+        return
+    if job.status == "completed":
+        batch.completed += 1
+    else:
+        batch.failed += 1
+    batch.updated_at = job.updated_at
+
+def generation_info(request: analysisRequest, seq: Sequence) -> Dict[str, Any]:
+    think_tokens = count_thinking_tokens(tokenizer, seq.output_ids, request.enable_thinking)
+    return {
+        "finish_reason": seq.finish_reason,
+        "prompt_tokens": len(seq.prompt_ids),
+        "completion_tokens": len(seq.output_ids),
+        "think_tokens": think_tokens,
+        "answer_tokens": len(seq.output_ids) - think_tokens,
+        # budget left unused because decoding stopped at the closing tag
+        "tokens_saved": seq.max_new_tokens - len(seq.output_ids) if seq.finish_reason == "stop" else 0,
+    }
+
+def stage_timings(seq: Sequence) -> Dict[str, float]:
+    # seconds between the stage marks; stages a sequence never reached are left out
+    marks = seq.timings
+
+    def span(start: str, end: str) -> Optional[float]:
+        return marks[end] - marks[start] if start in marks and end in marks else None
+    wait = [span("submitted", "admitted"), span("tokenized", "prefill_start")]
+    timings = {
+        "template": span("template_start", "template_end"),
+        "backend_wait": sum(wait) if None not in wait else None,
+        "tokenize": span("admitted", "tokenized"),
+        "prefill": span("prefill_start", "first_token"),
+        "decode": span("first_token", "generated"),
+        "decode_text": span("generated", "decoded"),
+        "parse": span("parse_start", "parsed"),
+    }
+    return {stage: round(seconds, 6) for stage, seconds in timings.items() if seconds is not None}
+
+def build_prompt(request: analysisRequest) -> str:
     messages = [
         {"role": "system", "content": SYSTEM_PROMPT},
         {"role": "user", "content": f"متا دیتا راجب سوال: {request.question_metadata},\n\n سوال: {request.question}\n\nپاسخ سازمان: {request.organization_answer}\n\nلطفاً این پاسخ را ارزیابی کرده و نتیجه را در فرمت XML ارائه دهید."}
     ]
     
-    prompt = tokenizer.apply_chat_template(
+    return tokenizer.apply_chat_template(
         messages,
         tokenize=False,
         add_generation_prompt=True,
-        enable_thinking=True
+        enable_thinking=request.enable_thinking
     )
-    inputs = tokenizer(prompt, return_tensors="pt").to("cuda")
 
-    print("waiting to get the answer from model!...")
-    outputs = model.generate(
-        **inputs,
-        max_new_tokens=2048,
-        temperature=0.6,
-        top_p=0.9,
-        top_k=20,
-        do_sample=True,
-        pad_token_id=tokenizer.eos_token_id,
-        eos_token_id=tokenizer.eos_token_id,
-    )
-    
-    generated_tokens = outputs[0][inputs['input_ids'].shape[1]:]
-    assistant_response = tokenizer.decode(generated_tokens, skip_special_tokens=True)
+def parse_model_output(request: analysisRequest, assistant_response: str) -> Dict[str, Any]:
     match = re.search(r"<score>(.*?)</score>", assistant_response, re.DOTALL)
     if match:
         score = match.group(1).strip()
@@ -138,44 +724,440 @@ def sync_process_request(request: analysisRequest) -> Dict[str, Any]:
     }
     return output
 
+def sync_process_batch(requests: List[analysisRequest]) -> List[Dict[str, Any]]:
+    load_backend()
+    results: List[Optional[Dict[str, Any]]] = [None] * len(requests)
+    keys = [request_cache_key(request) for request in requests]
+    if result_cache.enabled:
+        for index, request in enumerate(requests):
+            cached = None if request.bypass_cache else result_cache.get(keys[index])
+            if cached is not None:
+                results[index] = dict(cached, cached=True)
+                jobs_deduplicated.inc(source="cache")
+    misses = [index for index, result in enumerate(results) if result is None]
+    if not misses:
+        return results
+
+    prompts, template_spans = [], []
+    for index in misses:
+        template_start = time.monotonic()
+        prompts.append(build_prompt(requests[index]))
+        template_spans.append((template_start, time.monotonic()))
+    print("waiting to get the answer from model!...")
+    controls = [decoding_controls(requests[index]) for index in misses]
+    started = time.monotonic()
+    seqs = backend.generate_batch(
+        prompts,
+        stops=[control["stop"] for control in controls],
+        logits_processors=[control["logits_processor"] for control in controls],
+    )
+    generation_seconds.observe(time.monotonic() - started)
+    for index, seq, (template_start, template_end) in zip(misses, seqs, template_spans):
+        if seq.error is not None:
+            raise RuntimeError(seq.error)
+        prompt_tokens_total.inc(len(seq.prompt_ids))
+        generated_tokens_total.inc(len(seq.output_ids))
+        seq.timings.update(template_start=template_start, template_end=template_end)
+        seq.mark("parse_start")
+        result = parse_model_output(requests[index], seq.text)
+        seq.mark("parsed")
+        result["generation"] = generation_info(requests[index], seq)
+        if not is_complete_result(result):
+            parse_failures.inc()
+        elif result_cache.enabled:
+            result_cache.put(keys[index], result)
+        results[index] = dict(result, timings=stage_timings(seq))
+    return results
+
+def sync_process_request(request: analysisRequest) -> Dict[str, Any]:
+    return sync_process_batch([request])[0]
+
+def resolve_tenant(request: analysisRequest, http_request: Request) -> str:
+    tenant = http_request.headers.get("x-tenant-id") or request.question_metadata.get(TENANT_METADATA_KEY)
+    return str(tenant) if tenant else "default"
+
+def backend_failed_response() -> Optional[JSONResponse]:
+    # queued jobs would never run once the model failed to load
+    if backend_status != "failed":
+        return None
+    return JSONResponse(status_code=503, content={"error": "Model failed to load", "detail": backend_error})
+
 @app.post("/jobs")
-async def create_job(request: analysisRequest, background_tasks: BackgroundTasks):
-    global current_job_id, job_queue
+async def create_job(request: analysisRequest, http_request: Request):
+    failed = backend_failed_response()
+    if failed is not None:
+        return failed
+    cached = await lookup_cached_result(request)
+    if cached is not None:
+        now = datetime.now()
+        job = Job(
+            job_id=str(uuid4()),
+            status="completed",
+            request=request,
+            result=cached,
+            tenant=resolve_tenant(request, http_request),
+            created_at=now,
+            updated_at=now
+        )
+        jobs[job.job_id] = job
+        job_store.put(job)
+        resident_jobs.add(job)
+        return {"job_id": job.job_id, "status": "accepted"}
+
     job_id = str(uuid4())
     now = datetime.now()
     job = Job(
         job_id=job_id,
         status="pending",
         request=request,
+        tenant=resolve_tenant(request, http_request),
         created_at=now,
         updated_at=now
     )
-    jobs[job_id] = job
+    # retries of a job that is still running add no load, so skip backpressure
+    if attach_to_inflight(job):
+        job_store.put(job)
+        return {"job_id": job_id, "status": "accepted"}
 
-    if current_job_id is None:
-        current_job_id = job_id
-        background_tasks.add_task(process_job, job_id)
-    else:
-        job_queue.append(job_id)
+    cost = estimate_job_tokens(request)
+    retry_after = retry_after_seconds(cost)
+    if retry_after is not None:
+        return JSONResponse(
+            status_code=429,
+            content={"error": "Job queue is full", "retry_after": retry_after},
+            headers={"Retry-After": str(retry_after)}
+        )
+
+    enqueue_job(job, cost)
+    job_store.put(job)
+    schedule_jobs()
 
     return {"job_id": job_id, "status": "accepted"}
 
-@app.get("/jobs/{job_id}")
-async def get_job_status(job_id: str):
-    if job_id not in jobs:
-        return {"error": "Job not found"}, 404
-    job = jobs[job_id]
+def prefix_group(request: analysisRequest) -> tuple:
+    # prompts with the same metadata and question share their KV prefix
+    return (json.dumps(request.question_metadata, sort_keys=True, ensure_ascii=False), request.question)
+
+def parse_batch(body: bytes, ndjson: bool) -> List[analysisRequest]:
+    if ndjson:
+        return [analysisRequest.model_validate_json(line) for line in body.splitlines() if line.strip()]
+    return batch_requests_adapter.validate_json(body)
+
+def prepare_batch(requests: List[analysisRequest], tenants: List[str], batch_id: str) -> tuple:
+    # The per-job work of a batch, run in a worker thread so thousands of
+    # jobs do not stall the event loop: cache keys and lookups, the Job
+    # objects, and prompt rendering + tokenization for the token estimates
+    keys = [request_cache_key(request) for request in requests]
+    cached = [
+        result_cache.get(key) if result_cache.enabled and not request.bypass_cache else None
+        for request, key in zip(requests, keys)
+    ]
+    hits = sum(result is not None for result in cached)
+    if hits:
+        jobs_deduplicated.inc(hits, source="cache")
+    now = datetime.now()
+    batch_jobs = [
+        Job(
+            job_id=str(uuid4()),
+            status="completed" if result is not None else "pending",
+            request=request,
+            result=dict(result, cached=True) if result is not None else None,
+            tenant=tenant,
+            batch_id=batch_id,
+            created_at=now,
+            updated_at=now
+        )
+        for request, result, tenant in zip(requests, cached, tenants)
+    ]
+    job_keys = {job.job_id: key for job, key in zip(batch_jobs, keys)}
+    fresh = [job for job in batch_jobs if job.result is None]
+    costs = dict(zip((job.job_id for job in fresh), estimate_batch_tokens([job.request for job in fresh]))) if fresh else {}
+    # queue order: grouped by shared prompt prefix so they run back to back
+    # and reuse each other's prefix cache blocks
+    fresh.sort(key=lambda job: prefix_group(job.request))
+    return batch_jobs, fresh, job_keys, costs
+
+def persist_batch(batch_jobs: List[Job]) -> Dict[str, int]:
+    # store writes, and resident sizes of the jobs answered from the cache
+    for job in batch_jobs:
+        job_store.put(job)
+    return {job.job_id: len(job.model_dump_json()) for job in batch_jobs if job.result is not None}
+
+@app.post("/jobs/batch")
+async def create_batch(http_request: Request):
+    # JSON array of analysisRequest, or one request per line with an NDJSON content type
+    failed = backend_failed_response()
+    if failed is not None:
+        return failed
+    body = await http_request.body()
+    try:
+        requests = await asyncio.to_thread(parse_batch, body, "ndjson" in http_request.headers.get("content-type", ""))
+    except ValidationError as e:
+        return JSONResponse(status_code=422, content={"error": "Invalid batch", "detail": json.loads(e.json())})
+    if not requests:
+        return JSONResponse(status_code=422, content={"error": "Empty batch"})
+
+    batch_id = str(uuid4())
+    tenants = [resolve_tenant(request, http_request) for request in requests]
+    batch_jobs, fresh, keys, costs = await asyncio.to_thread(prepare_batch, requests, tenants, batch_id)
+    # in-flight jobs may have started or finished while preparing, so this is decided now
+    new_work = [job for job in fresh if keys[job.job_id] not in inflight_jobs or job.request.bypass_cache]
+    if len(new_work) > MAX_BATCH_QUEUE_DEPTH:
+        return JSONResponse(
+            status_code=413,
+            content={"error": f"Batch has {len(new_work)} new jobs, batches can queue at most {MAX_BATCH_QUEUE_DEPTH}"}
+        )
+    cost = sum(costs[job.job_id] for job in new_work)
+    if cost > MAX_BATCH_QUEUED_TOKENS:
+        return JSONResponse(
+            status_code=413,
+            content={"error": f"Batch needs about {cost} tokens, batches can queue at most {MAX_BATCH_QUEUED_TOKENS}"}
+        )
+    retry_after = retry_after_seconds(cost, len(new_work), pool="batches")
+    if retry_after is not None:
+        return JSONResponse(
+            status_code=429,
+            content={"error": "Job queue is full", "retry_after": retry_after},
+            headers={"Retry-After": str(retry_after)}
+        )
+
+    # Written before the jobs are queued so a later status write cannot be
+    # overtaken by this one. Other submissions admitted meanwhile can take
+    # the pool slightly past its limits, which are estimates anyway.
+    sizes = await asyncio.to_thread(persist_batch, batch_jobs)
+    now = datetime.now()
+    batch = batches[batch_id] = Batch(
+        batch_id=batch_id,
+        job_ids=[job.job_id for job in batch_jobs],
+        created_at=now,
+        updated_at=now
+    )
+    for job in batch_jobs:
+        if job.result is not None:
+            jobs[job.job_id] = job
+            resident_jobs.add(job, sizes[job.job_id])
+            record_batch_progress(job)
+    for job in fresh:
+        if not attach_to_inflight(job, keys[job.job_id]):
+            enqueue_job(job, costs[job.job_id], keys[job.job_id])
+    schedule_jobs()
+
+    return {"batch_id": batch_id, "job_ids": batch.job_ids, "status": "accepted"}
+
+@app.get("/batches/{batch_id}")
+async def get_batch_status(batch_id: str):
+    batch = batches.get(batch_id)
+    if batch is None:
+        return JSONResponse(status_code=404, content={"error": "Batch not found"})
+    total = len(batch.job_ids)
+    finished = batch.completed + batch.failed
+    return {
+        "batch_id": batch.batch_id,
+        "status": "completed" if finished == total else "processing",
+        "total": total,
+        "completed": batch.completed,
+        "failed": batch.failed,
+        "remaining": total - finished,
+        "progress": finished / total,
+        "created_at": batch.created_at.isoformat(),
+        "updated_at": batch.updated_at.isoformat(),
+        "job_ids": batch.job_ids
+    }
+
+def enqueue_job(job: Job, cost: int, key: Optional[str] = None):
+    global queued_tokens
+    jobs[job.job_id] = job
+    job_streams[job.job_id] = JobStream(thinking=job.request.enable_thinking)
+    job_done_events[job.job_id] = asyncio.Event()
+    job_queue.push(job.job_id, job.request.priority, job.tenant, cost)
+    job_costs[job.job_id] = cost
+    queued_tokens += cost
+    pool = queue_pool(job)
+    pool_depth[pool] += 1
+    pool_tokens[pool] += cost
+    if COALESCE_DUPLICATES:
+        inflight_jobs.setdefault(key or request_cache_key(job.request), job.job_id)
+
+@app.on_event("startup")
+async def recover_jobs():
+    # Re-queue jobs that were pending or mid-generation when the server stopped
+    loop = asyncio.get_running_loop()
+    for job in await loop.run_in_executor(None, job_store.unfinished):
+        job.status = "pending"
+        job.coalesced_with = None
+        if not attach_to_inflight(job):
+            enqueue_job(job, estimate_job_tokens(job.request))
+    schedule_jobs()
+
+@app.on_event("startup")
+async def start_retention_sweep():
+    async def sweep():
+        while True:
+            await asyncio.sleep(60)
+            resident_jobs.sweep()
+            now = datetime.now()
+            for batch_id in [
+                batch.batch_id for batch in batches.values()
+                if batch.completed + batch.failed == len(batch.job_ids)
+                and (now - batch.updated_at).total_seconds() > JOB_RETENTION_SECONDS
+            ]:
+                del batches[batch_id]
+    asyncio.create_task(sweep())
+
+@app.on_event("shutdown")
+async def close_job_store():
+    job_store.close()
+
+async def find_job(job_id: str) -> Optional[Job]:
+    if job_id in jobs:
+        resident_jobs.touch(job_id)
+        return jobs[job_id]
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, job_store.get, job_id)
+
+def job_response(job: Job) -> Dict[str, Any]:
     response = {
         "job_id": job.job_id,
         "status": job.status,
         "created_at": job.created_at.isoformat(),
         "updated_at": job.updated_at.isoformat()
     }
-    if job.status == "completed":
+    queued_id = job.coalesced_with or job.job_id
+    if job.status == "pending" and queued_id in job_queue:
+        response["queue_position"] = job_queue.position(queued_id)
+    elif job.status == "completed":
         response["result"] = job.result
     elif job.status == "failed":
         response["error"] = job.error
+    if job.timings:
+        response["timings"] = job.timings
     return response
 
+@app.post("/jobs/status")
+async def get_jobs_status(status_request: JobStatusRequest):
+    if len(status_request.job_ids) > 1000:
+        return JSONResponse(status_code=413, content={"error": "At most 1000 job ids per request"})
+    found = {job_id: jobs[job_id] for job_id in status_request.job_ids if job_id in jobs}
+    missing = [job_id for job_id in status_request.job_ids if job_id not in found]
+    if missing:
+        # one store round trip for everything no longer resident
+        loop = asyncio.get_running_loop()
+        for job in await loop.run_in_executor(None, job_store.get_many, missing):
+            found[job.job_id] = job
+    return {
+        "jobs": [job_response(found[job_id]) for job_id in status_request.job_ids if job_id in found],
+        "not_found": [job_id for job_id in status_request.job_ids if job_id not in found]
+    }
+
+def encode_cursor(job: Job) -> str:
+    return base64.urlsafe_b64encode(f"{job.created_at.isoformat()}|{job.job_id}".encode()).decode()
+
+def decode_cursor(cursor: str) -> tuple:
+    created_at, job_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|", 1)
+    return created_at, job_id
+
+@app.get("/jobs")
+async def list_jobs(status: Optional[str] = None, cursor: Optional[str] = None, limit: int = 100):
+    # newest first; pass next_cursor back to get the following page
+    limit = min(max(limit, 1), 1000)
+    try:
+        before = decode_cursor(cursor) if cursor else None
+    except ValueError:
+        return JSONResponse(status_code=400, content={"error": "Invalid cursor"})
+    loop = asyncio.get_running_loop()
+    page = await loop.run_in_executor(None, job_store.page, status, before, limit)
+    if page is None:
+        return JSONResponse(status_code=501, content={"error": "The job store keeps no index to list jobs from"})
+    next_cursor = encode_cursor(page[-1]) if len(page) == limit else None
+    # the store is written behind, resident jobs carry the latest status
+    page = [jobs.get(job.job_id, job) for job in page]
+    return {
+        "jobs": [job_response(job) for job in page if status is None or job.status == status],
+        "next_cursor": next_cursor
+    }
+
+@app.get("/jobs/{job_id}")
+async def get_job_status(job_id: str, wait: float = 0):
+    job = await find_job(job_id)
+    if job is None:
+        return JSONResponse(status_code=404, content={"error": "Job not found"})
+    done_event = job_done_events.get(job_id)
+    if wait > 0 and done_event is not None:
+        # long-poll: hold the request until the job finishes or wait runs out
+        try:
+            await asyncio.wait_for(done_event.wait(), timeout=min(wait, LONG_POLL_MAX_SECONDS))
+        except asyncio.TimeoutError:
+            pass
+    return job_response(jobs.get(job_id, job))
+
+def sse_event(event: str, data: Dict[str, Any]) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+@app.get("/jobs/{job_id}/stream")
+async def stream_job(job_id: str):
+    job = await find_job(job_id)
+    if job is None:
+        return JSONResponse(status_code=404, content={"error": "Job not found"})
+    stream = job_streams.get(job_id)
+
+    async def events():
+        if stream is None:
+            # already finished, replay the stored result
+            if job.result is not None:
+                yield sse_event("token", {"text": job.result["raw_output"]})
+                for index, cause in enumerate(job.result["root_causes"]):
+                    yield sse_event("cause", {"index": index, "cause": cause})
+            yield sse_event("done", job_response(job))
+            return
+        queue = stream.subscribe()
+        try:
+            while True:
+                event, data = await queue.get()
+                if event == "done" and job.coalesced_with is not None:
+                    # the shared stream reports the leader job, answer with this one
+                    data = job_response(jobs.get(job_id, job))
+                yield sse_event(event, data)
+                if event == "done":
+                    break
+        finally:
+            stream.subscribers.remove(queue)
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+@app.get("/metrics")
+async def get_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/resident_jobs")
+async def get_resident_jobs_stats():
+    return resident_jobs.stats()
+
+@app.get("/result_cache")
+async def get_result_cache_stats():
+    return result_cache.stats()
+
+@app.get("/prefix_cache")
+async def get_prefix_cache_stats():
+    return backend.prefix_cache_stats()
+
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    parser = argparse.ArgumentParser()
+    # offline mode: score a JSONL file of analysisRequest records without the HTTP server
+    parser.add_argument("--batch-input", help="JSONL file of analysisRequest records")
+    parser.add_argument("--batch-output", help="JSONL results, also used to resume an interrupted run")
+    parser.add_argument("--batch-window", type=int, default=MAX_BATCH_SIZE * 8, help="records sorted by length together")
+    args = parser.parse_args()
+    if args.batch_input:
+        load_backend()
+        run_jsonl(
+            args.batch_input,
+            args.batch_output or args.batch_input + ".results.jsonl",
+            analysisRequest,
+            sync_process_batch,
+            prompt_length=lambda request: len(build_prompt(request)),
+            batch_size=MAX_BATCH_SIZE,
+            window=args.batch_window,
+        )
+        job_store.close()
+    else:
+        uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
@@ -0,0 +1,110 @@
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+import torch
+
+
+class _Node:
+    __slots__ = ("key", "parent", "children", "layers", "nbytes", "pinned")
+
+    def __init__(self, key: tuple, parent: Optional["_Node"], layers: List[tuple], pinned: bool):
+        self.key = key
+        self.parent = parent
+        self.children: Dict[tuple, "_Node"] = {}
+        self.layers = layers
+        self.nbytes = sum(k.numel() * k.element_size() + v.numel() * v.element_size() for k, v in layers)
+        self.pinned = pinned
+
+
+class PrefixCache:
+    # Radix tree over prompt tokens. Every edge is one block of block_tokens
+    # token ids and its node owns the KV tensors ([1, heads, block, dim] per
+    # layer) for that block, so a lookup walks the tree block by block and
+    # concatenates the KV of the longest cached prefix. Unpinned leaves are
+    # evicted least-recently-used first once max_bytes is exceeded.
+    def __init__(self, block_tokens: int = 32, max_bytes: int = 4 << 30):
+        self.block_tokens = block_tokens
+        self.max_bytes = max_bytes
+        self.root = _Node((), None, [], True)
+        self._lru: "OrderedDict[_Node, None]" = OrderedDict()
+        self.bytes = 0
+        self.lookups = 0
+        self.hits = 0
+        self.lookup_tokens = 0
+        self.hit_tokens = 0
+        self.bytes_saved = 0
+        self.evictions = 0
+
+    def _blocks(self, token_ids: List[int], limit: int) -> List[tuple]:
+        size = self.block_tokens
+        return [tuple(token_ids[i * size:(i + 1) * size]) for i in range(limit // size)]
+
+    def match(self, token_ids: List[int], limit: Optional[int] = None) -> Tuple[int, Optional[List[tuple]]]:
+        limit = len(token_ids) if limit is None else min(limit, len(token_ids))
+        self.lookups += 1
+        self.lookup_tokens += len(token_ids)
+        node, path = self.root, []
+        for key in self._blocks(token_ids, limit):
+            node = node.children.get(key)
+            if node is None:
+                break
+            path.append(node)
+        if not path:
+            return 0, None
+        for node in path:
+            self._lru.move_to_end(node)
+        layers = [
+            (torch.cat([node.layers[idx][0] for node in path], dim=2),
+             torch.cat([node.layers[idx][1] for node in path], dim=2))
+            for idx in range(len(path[0].layers))
+        ]
+        matched = len(path) * self.block_tokens
+        self.hits += 1
+        self.hit_tokens += matched
+        self.bytes_saved += sum(node.nbytes for node in path)
+        return matched, layers
+
+    def insert(self, token_ids: List[int], layers: List[tuple], pinned: bool = False) -> None:
+        size = self.block_tokens
+        node = self.root
+        for idx, key in enumerate(self._blocks(token_ids, min(len(token_ids), layers[0][0].shape[2]))):
+            child = node.children.get(key)
+            if child is None:
+                # clone so the block does not keep the whole prompt cache alive
+                block = [(k[:, :, idx * size:(idx + 1) * size].clone(), v[:, :, idx * size:(idx + 1) * size].clone())
+                         for k, v in layers]
+                child = _Node(key, node, block, pinned)
+                node.children[key] = child
+                self.bytes += child.nbytes
+            elif pinned:
+                child.pinned = True
+            self._lru[child] = None
+            self._lru.move_to_end(child)
+            node = child
+        self._evict()
+
+    def _evict(self) -> None:
+        while self.bytes > self.max_bytes:
+            # parents are touched with their children, so the oldest entries are leaves
+            victim = next((node for node in self._lru if not node.children and not node.pinned), None)
+            if victim is None:
+                return
+            del victim.parent.children[victim.key]
+            del self._lru[victim]
+            self.bytes -= victim.nbytes
+            self.evictions += 1
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "blocks": len(self._lru),
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+            "lookups": self.lookups,
+            "hits": self.hits,
+            "hit_rate": self.hits / self.lookups if self.lookups else 0.0,
+            "token_hit_rate": self.hit_tokens / self.lookup_tokens if self.lookup_tokens else 0.0,
+            "lookup_tokens": self.lookup_tokens,
+            "hit_tokens": self.hit_tokens,
+            "bytes_saved": self.bytes_saved,
+            "evictions": self.evictions,
+        }
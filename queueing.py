@@ -0,0 +1,116 @@
+import heapq
+from bisect import bisect_left
+from typing import Callable, Dict, List, Optional, Sequence
+
+
+class _TenantQueue:
+    __slots__ = ("items", "head", "last_finish")
+
+    def __init__(self):
+        # (finish tag, sequence number, job id) of queued jobs; tags only
+        # grow, so items[head:] stays sorted and can be bisected
+        self.items: List[tuple] = []
+        self.head = 0
+        self.last_finish = 0.0
+
+    def __len__(self) -> int:
+        return len(self.items) - self.head
+
+    def popleft(self) -> tuple:
+        item = self.items[self.head]
+        self.head += 1
+        if self.head > 64 and self.head * 2 > len(self.items):
+            del self.items[:self.head]
+            self.head = 0
+        return item
+
+
+class JobQueue:
+    # Strict priority between classes and weighted fair queuing between
+    # tenants inside a class. Every job gets a virtual finish tag
+    # max(class virtual time, tenant's last tag) + cost / weight, and the
+    # smallest tag is served first, so a tenant with a huge backlog only
+    # delays others by its fair share. The heap holds one entry per
+    # non-empty tenant (its oldest job), so push/pop are O(log tenants) and
+    # skipping tenants at their concurrency cap costs one entry each. A
+    # job's position is found by bisecting each tenant's sorted tags.
+    def __init__(self, classes: Sequence[str] = ("interactive", "bulk"), weights: Optional[Dict[str, float]] = None):
+        self.ranks = {name: rank for rank, name in enumerate(classes)}
+        self.weights = weights or {}
+        for tenant, weight in self.weights.items():
+            # a tag advances by cost / weight, so the weight has to be positive
+            if not weight > 0:
+                raise ValueError(f"weight of tenant {tenant!r} must be greater than 0, got {weight}")
+        self._heap: List[tuple] = []
+        self._entries: Dict[str, tuple] = {}
+        self._tenants: Dict[str, Dict[str, _TenantQueue]] = {name: {} for name in classes}
+        self._virtual_time = {name: 0.0 for name in classes}
+        self._depth = {name: 0 for name in classes}
+        self._seq = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, job_id: str) -> bool:
+        return job_id in self._entries
+
+    def push(self, job_id: str, priority: str = "interactive", tenant: str = "default", cost: float = 1.0) -> None:
+        tenants = self._tenants[priority]
+        queue = tenants.get(tenant)
+        if queue is None:
+            queue = tenants[tenant] = _TenantQueue()
+        start = max(self._virtual_time[priority], queue.last_finish)
+        finish = start + cost / self.weights.get(tenant, 1.0)
+        queue.last_finish = finish
+        self._seq += 1
+        queue.items.append((finish, self._seq, job_id))
+        if len(queue) == 1:
+            heapq.heappush(self._heap, (self.ranks[priority], finish, self._seq, priority, tenant))
+        self._entries[job_id] = (priority, tenant, finish, self._seq)
+        self._depth[priority] += 1
+
+    def pop(self, eligible: Optional[Callable[[str], bool]] = None) -> Optional[str]:
+        # eligible(tenant) lets the scheduler skip tenants at their concurrency cap
+        skipped = []
+        head = None
+        while self._heap:
+            head = heapq.heappop(self._heap)
+            if eligible is None or eligible(head[4]):
+                break
+            skipped.append(head)
+            head = None
+        for entry in skipped:
+            heapq.heappush(self._heap, entry)
+        if head is None:
+            return None
+        _, finish, _, priority, tenant = head
+        tenants = self._tenants[priority]
+        queue = tenants[tenant]
+        job_id = queue.popleft()[2]
+        del self._entries[job_id]
+        self._depth[priority] -= 1
+        self._virtual_time[priority] = max(self._virtual_time[priority], finish)
+        if queue:
+            next_finish, next_seq, _ = queue.items[queue.head]
+            heapq.heappush(self._heap, (self.ranks[priority], next_finish, next_seq, priority, tenant))
+        elif queue.last_finish <= self._virtual_time[priority]:
+            del tenants[tenant]
+        return job_id
+
+    def position(self, job_id: str) -> Optional[int]:
+        entry = self._entries.get(job_id)
+        if entry is None:
+            return None
+        priority, _, finish, seq = entry
+        rank = self.ranks[priority]
+        ahead = sum(depth for name, depth in self._depth.items() if self.ranks[name] < rank)
+        for queue in self._tenants[priority].values():
+            ahead += bisect_left(queue.items, (finish, seq), queue.head) - queue.head
+        return ahead
+
+    def tenant_of(self, job_id: str) -> Optional[str]:
+        entry = self._entries.get(job_id)
+        return entry[1] if entry is not None else None
+
+    def depth(self, priority: str) -> int:
+        return self._depth[priority]
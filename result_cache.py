@@ -0,0 +1,94 @@
+import hashlib
+import json
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+
+def cache_key(payload: Dict[str, Any]) -> str:
+    # sort_keys canonicalizes nested dicts such as question_metadata
+    canonical = json.dumps(payload, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class ResultCache:
+    # In-memory LRU of analysis results keyed by content hash. With a path,
+    # entries evicted from memory stay in a SQLite tier that keeps the most
+    # recently written max_disk_entries results.
+    def __init__(self, max_entries: int = 10000, path: Optional[str] = None, max_disk_entries: int = 1000000):
+        self.max_entries = max_entries
+        self.path = path
+        self.max_disk_entries = max_disk_entries
+        self._memory: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._conn: Optional[sqlite3.Connection] = None
+        # disk reads/writes run in executor threads, so both tiers are locked
+        self._lock = threading.Lock()
+        self._memory_lock = threading.Lock()
+        if path:
+            self._conn = sqlite3.connect(path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+            self._disk_entries = self._conn.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0 or self._conn is not None
+
+    def get_memory(self, key: str) -> Optional[Dict[str, Any]]:
+        with self._memory_lock:
+            result = self._memory.get(key)
+            if result is not None:
+                self._memory.move_to_end(key)
+                self.hits += 1
+        return result
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        result = self.get_memory(key)
+        if result is not None or self._conn is None:
+            if result is None:
+                self.misses += 1
+            return result
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM results WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.disk_hits += 1
+        result = json.loads(row[0])
+        self._remember(key, result)
+        return result
+
+    def put(self, key: str, result: Dict[str, Any]) -> None:
+        self._remember(key, result)
+        if self._conn is None:
+            return
+        with self._lock, self._conn:
+            inserted = self._conn.execute(
+                "INSERT OR REPLACE INTO results (key, value) VALUES (?, ?)", (key, json.dumps(result, ensure_ascii=False))
+            ).lastrowid
+            self._disk_entries += 1
+            if self._disk_entries > self.max_disk_entries:
+                # rowid grows with every write, so the smallest ones are the oldest
+                self._conn.execute("DELETE FROM results WHERE rowid <= ?", (inserted - self.max_disk_entries,))
+                self._disk_entries = self._conn.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+
+    def _remember(self, key: str, result: Dict[str, Any]) -> None:
+        if self.max_entries <= 0:
+            return
+        with self._memory_lock:
+            self._memory[key] = result
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_entries:
+                self._memory.popitem(last=False)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "memory_entries": len(self._memory),
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+        }